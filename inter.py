@@ -1,3 +1,4 @@
+import io
 import json
 import os
 import shutil
@@ -15,8 +16,9 @@ from PySide6.QtCore import Qt
 
 from lib.collect import collect_tests, collect_problem, collected_problem
 from lib.core import VERSION, _fexc, error, tick, tock
+from lib.datafile import open_data
 from lib.ds import ModelNULL, TestConf, JudgeConf, Test
-from lib.utils import stdopen, path_cmp, backup as _backup, restore as _restore
+from lib.utils import stdopen, path_key, backup as _backup, restore as _restore
 from libg.color import *
 from libg.switcher import ExSwitcher, SwitcherItem
 
@@ -34,7 +36,7 @@ def xdgopen(path: str):
 
 @lru_cache
 def _read_truncated(path: str, *, trunc = 1000):
-    with stdopen(path) as file:
+    with io.TextIOWrapper(open_data(path), "utf-8") as file:
         x = file.read(trunc)
         if file.read(1):
             x += "\n<truncated>"
@@ -215,7 +217,7 @@ class MainWindow(QMainWindow):
             tick()
             with collect_problem():
                 self.tests, self.testconf = collect_tests(self.data_dir)
-            self.tests.sort(key=lambda x: path_cmp(x.tests[0][0]))
+            self.tests.sort(key=lambda x: path_key(x.tests[0][0]))
             tock("collect & sort")
             self.judgeconf = collected_problem()
             tick()
@@ -1,117 +1,271 @@
+import json
 import os
-from contextlib import contextmanager
+import time
+from contextlib import contextmanager, suppress
 from itertools import chain, islice
 
 from .core import warning
-from .ds import read_test_conf, JudgeConf, Test
-from .utils import is_xok, path_cmp
+from .datafile import archived, compression, real_path, strip, supported
+from .ds import _read_conf, read_test_conf, JudgeConf, Test
+from .utils import is_xok, name_key, cache_file, get_unique_path
+
+# 数据文件夹索引
+# 记录每个目录的文件列表（以目录的修改时间校验，目录中增删或重命名文件时修改时间才会变化）、每个子任务的收集结果（以其中所有目录的修改时间校验）和解析过的配置文件（以大小和修改时间校验）
+# 数据没有变化时，收集测试点只需要对每个目录调用一次 stat，不需要列出目录、配对输入输出文件或重新解析配置文件
+# 文件内容的哈希记录在 utils 模块的文件哈希索引中
+_INDEX_MAX = 1 << 17
+_INDEX_TABLES = ("dirs", "scans", "confs")
+_index: dict[str, dict[str, list]] | None = None
+_index_dirty = False
+_files: dict[str, frozenset[str]] = {} # 本次收集中已经列出的目录的文件集合
+_mtimes: dict[str, int] = {} # 本次收集中已经列出的目录的修改时间
+def _load_index():
+    global _index
+    if _index is None:
+        _index = {table: {} for table in _INDEX_TABLES}
+        if (path := cache_file("collect.json")) is not None:
+            try:
+                with open(path) as file:
+                    data = json.load(file)
+                if isinstance(data, dict) and all(isinstance(data.get(table), dict) for table in _INDEX_TABLES):
+                    _index = data
+            except (OSError, ValueError):
+                pass
+    return _index
+def _save_index():
+    global _index_dirty
+    if not _index_dirty or (path := cache_file("collect.json")) is None:
+        return
+    _index_dirty = False
+    for table in _index.values():
+        while len(table) > _INDEX_MAX:
+            del table[next(iter(table))]
+    tmp = get_unique_path(os.path.dirname(path)) + ".tmp"
+    try:
+        with open(tmp, "w") as file:
+            json.dump(_index, file)
+        os.replace(tmp, path)
+    except OSError:
+        with suppress(OSError):
+            os.remove(tmp)
+def _fresh(mtime_ns: int):
+    # 刚修改过的目录或文件可能在同一时间戳内再次被修改，不记录
+    return time.time_ns() - mtime_ns < 2 * 10**9
+def _listdir(path: str) -> tuple[list[str], list[str]]:
+    """
+    返回目录 path 中的 (文件名列表, 子目录名列表)，子目录包括指向目录的符号链接。
+    """
+    global _index_dirty
+    dirs = _load_index()["dirs"]
+    if (x := archived(path)) is not None:
+        # 压缩包中的目录直接使用压缩包的目录索引
+        archive, member = x
+        files, subdirs = archive.dirs[member]
+        mtime = archive.mtime
+    elif (x := dirs.get(path)) is not None and x[0] == (mtime := os.stat(path).st_mtime_ns):
+        files, subdirs = x[1], x[2]
+    else:
+        # 先取得修改时间再列出目录，列出目录期间的修改会使记录的修改时间失效
+        if x is None:
+            mtime = os.stat(path).st_mtime_ns
+        files, subdirs = [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                (subdirs if entry.is_dir() else files).append(entry.name)
+        if not _fresh(mtime):
+            dirs[path] = [mtime, files, subdirs]
+            _index_dirty = True
+    _files[path] = frozenset(files)
+    _mtimes[path] = mtime
+    return files, subdirs
+def _walk(top: str):
+    # 与 os.walk 相同，不进入指向目录的符号链接
+    files, subdirs = _listdir(top)
+    yield top, subdirs, files
+    for name in subdirs:
+        if not os.path.islink(path := os.path.join(top, name)):
+            yield from _walk(path)
+def _isfile(path: str):
+    # 所在目录已经列出时直接查找，否则检查文件系统
+    if (files := _files.get(os.path.dirname(path))) is not None:
+        return os.path.basename(path) in files
+    return os.path.isfile(path)
+def _test_conf(path: str):
+    global _index_dirty
+    if archived(path) is not None:
+        return read_test_conf(path)
+    confs = _load_index()["confs"]
+    st = os.stat(path)
+    if (x := confs.get(path)) is not None and x[0] == st.st_size and x[1] == st.st_mtime_ns:
+        return read_test_conf(path, x[2])
+    if (data := _read_conf(path)) is None:
+        return
+    if not _fresh(st.st_mtime_ns):
+        confs[path] = [st.st_size, st.st_mtime_ns, data]
+        _index_dirty = True
+    return read_test_conf(path, data)
 
 _checkers = []
 _interactors = []
 _graders = []
 _headers = []
+_unmatched = [] # 没有匹配输入文件的输出文件
+_special = {"checkers": _checkers, "interactors": _interactors, "graders": _graders, "headers": _headers}
 ANSFILE_EXTS = ("ans", "out")
-def _find_ansfile_strict(path: str):
-    if path.endswith(".in"):
-        ret = []
-        dirpath = os.path.dirname(path)
-        for ex in ANSFILE_EXTS:
-            if os.path.isfile(p := os.path.join(dirpath, path[:-3] + ex)):
-                ret.append(p)
-        return ret
-    return path.endswith(".ans")
-def _find_ansfile_free(path: str):
-    dirpath = os.path.dirname(path)
+def _special_kind(name: str):
+    base, ext = os.path.splitext(name)
+    if base in ("checker", "chk"):
+        return "checkers"
+    elif base in ("interactor", ):
+        return "interactors"
+    elif base in ("grader", ):
+        return "graders"
+    elif ext in (".h", ".hpp"):
+        return "headers"
+def _find_ansfile_strict(name: str, names: frozenset[str], warnings: list):
+    if name.endswith(".in"):
+        return [p for ex in ANSFILE_EXTS if (p := name[:-3] + ex) in names]
+    return name.endswith(".ans")
+def _find_ansfile_free(name: str, names: frozenset[str], warnings: list):
     ret = False
-    cwd = os.getcwd()
-    for i, val in enumerate(comp := os.path.basename(path).split(".")):
+    for i, val in enumerate(comp := name.split(".")):
         if val == "in":
             if not isinstance(ret, list):
                 ret = []
             for ex in ANSFILE_EXTS:
-                if os.path.isfile(p := os.path.join(dirpath, ".".join(chain(islice(comp, i), (ex, ), islice(comp, i+1, None))))):
+                if (p := ".".join(chain(islice(comp, i), (ex, ), islice(comp, i+1, None)))) in names:
                     ret.append(p)
         elif val in ANSFILE_EXTS:
             if isinstance(ret, list):
-                warning(f"忽略 {repr(os.path.relpath(path, cwd))}，因为无法判断它是输入文件还是输出文件。", True)
+                warnings.append(("ambiguous", name))
                 return None
             ret = True
     return ret
-_ansfile = set()
-_matched_ansfile = set()
-def find_testcase(path: str, strict = False):
-    component = _find_ansfile_strict(path) if strict else _find_ansfile_free(path)
-    if component is None or component is False:
-        return
-    elif component is True:
-        if path in _matched_ansfile:
-            _matched_ansfile.remove(path)
+def _scan(files: list[str], strict: bool):
+    """
+    在一个目录的文件名列表中配对输入输出文件，只使用文件名表，不访问文件系统。
+    返回的结果中只有文件名，不依赖目录位置和工作目录，可以记录在索引中。
+    """
+    ret = {kind: [] for kind in _special}
+    tests = []
+    warnings = []
+    # 压缩的数据文件去掉压缩后缀后参与配对，与未压缩的文件同名时使用未压缩的文件
+    actual: dict[str, str] = {}
+    for name in files:
+        if compression(name) is None:
+            actual[name] = name
+        elif not supported(name):
+            warnings.append(("unsupported", name))
+    for name in files:
+        if compression(name) is not None and supported(name):
+            actual.setdefault(strip(name), name)
+    files = list(actual)
+    names = frozenset(files)
+    find = _find_ansfile_strict if strict else _find_ansfile_free
+    ansfile = {} # 尚未被匹配的输出文件，用字典保持插入顺序
+    matched = {} # 先被输入文件匹配、尚未出现的输出文件
+    for name in files:
+        if (kind := _special_kind(name)) is not None:
+            if actual[name] == name:
+                ret[kind].append(name)
+            continue
+        component = find(name, names, warnings)
+        if component is None or component is False:
+            continue
+        elif component is True:
+            if name in matched:
+                del matched[name]
+            else:
+                ansfile[name] = None
+            continue
+        for p in component:
+            if p in ansfile:
+                del ansfile[p]
+            else:
+                matched[p] = None
+        if component:
+            tests.append((name, component[0]))
+            warnings += (("multiple", name, p) for p in islice(component, 1, None))
         else:
-            _ansfile.add(path)
-        return
-    ansfile = None
+            warnings.append(("unmatched", name))
+    tests.sort(key=lambda x: name_key(x[0]))
+    ret.update(
+        tests=[(actual[infile], actual[ansfile]) for infile, ansfile in tests],
+        unmatched=[actual.get(name, name) for name in chain(ansfile, matched)],
+        warnings=[(kind, *(actual.get(name, name) for name in names)) for kind, *names in warnings],
+    )
+    return ret
+def _collect_dir(path: str, strict = False):
+    """
+    收集目录 path 中（不包括子目录）的测试点，同时记录特殊文件和没有匹配输入文件的输出文件，返回按文件名排序的 (输入文件, 输出文件) 列表。
+    """
+    global _index_dirty
+    scans = _load_index()["scans"]
+    files, subdirs = _listdir(path)
+    mtime = _mtimes[path]
+    key = f"{int(strict)}:{int(supported('.zst'))}:{path}"
+    if (x := scans.get(key)) is not None and x[0] == mtime:
+        ret = x[1]
+    else:
+        ret = _scan(files, strict)
+        if not _fresh(mtime):
+            scans[key] = [mtime, ret]
+            _index_dirty = True
+    for kind, lst in _special.items():
+        lst += (real_path(os.path.join(path, name)) for name in ret[kind])
+    _unmatched.extend(os.path.join(path, name) for name in ret["unmatched"])
     cwd = os.getcwd()
-    for p in component:
-        if p in _ansfile:
-            _ansfile.remove(p)
+    for kind, name, *other in ret["warnings"]:
+        name = repr(os.path.relpath(os.path.join(path, name), cwd))
+        if kind == "unsupported":
+            warning(f"忽略 {name}，需要安装 zstandard 才能读取 zstd 压缩的数据。", True)
+        elif kind == "ambiguous":
+            warning(f"忽略 {name}，因为无法判断它是输入文件还是输出文件。", True)
+        elif kind == "multiple":
+            warning(f"{name} 匹配多个输出文件，其中忽略 {repr(os.path.relpath(os.path.join(path, other[0]), cwd))}", True)
         else:
-            _matched_ansfile.add(p)
-        if ansfile is None:
-            ansfile = p
-        else:
-            warning(f"{repr(os.path.relpath(path, cwd))} 匹配多个输出文件，其中忽略 {repr(os.path.relpath(p, cwd))}", True)
-    if ansfile is None:
-        warning(f"{repr(os.path.relpath(path, cwd))}，没有匹配输出文件，被忽略。", True)
-    else:
-        return (path, ansfile)
-def process_file(path: str, strict = False, testcase = True):
-    name = os.path.basename(path)
-    base, ext = os.path.splitext(name)
-    if base in ("checker", "chk"):
-        _checkers.append(path)
-    elif base in ("interactor", ):
-        _interactors.append(path)
-    elif base in ("grader", ):
-        _graders.append(path)
-    elif ext in (".h", ".hpp"):
-        _headers.append(path)
-    elif testcase:
-        return find_testcase(path, strict)
+            warning(f"{name}，没有匹配输出文件，被忽略。", True)
+    return [(os.path.join(path, infile), os.path.join(path, ansfile)) for infile, ansfile in ret["tests"]]
+def process_file(path: str):
+    """
+    记录特殊文件（校验器、交互库、grader 和头文件）。
+    """
+    if (kind := _special_kind(os.path.basename(path))) is not None:
+        _special[kind].append(path)
 def collect_test(src: str, strict = False):
-    ret = [tc for dirpath, dirnames, filenames in os.walk(src) for file in filenames if (tc := process_file(os.path.join(dirpath, file), strict))]
+    # 各目录的结果已经按文件名排序，按目录路径排序后依次连接即可
+    ret = [tc for dirpath in sorted(dirpath for dirpath, _, _ in _walk(src)) for tc in _collect_dir(dirpath, strict)]
     if not ret:
         return None
-    ret.sort(key=lambda x: path_cmp(x[0]))
     t = Test(tests=ret)
-    if os.path.isfile(path := os.path.join(src, "config.json")):
-        t.conf = read_test_conf(path)
+    if _isfile(path := os.path.join(src, "config.json")):
+        t.conf = _test_conf(path)
     return t
 def collect_tests(src: str, strict = False):
     ret: list[Test] = []
-    for name in os.listdir(src):
-        path = os.path.join(src, name)
-        if os.path.isdir(path):
-            if tc := collect_test(path, strict):
-                ret.append(tc)
-        elif tc := process_file(path):
-            ret.append(Test(tests=[tc]))
-    return ret, read_test_conf(path) if os.path.isfile(path := os.path.join(src, "config.json")) else None
+    files, subdirs = _listdir(src)
+    for name in subdirs:
+        if tc := collect_test(os.path.join(src, name), strict):
+            ret.append(tc)
+    ret += (Test(tests=[tc]) for tc in _collect_dir(src))
+    conf = _test_conf(path) if _isfile(path := os.path.join(src, "config.json")) else None
+    _save_index()
+    return ret, conf
 __collected_problem = None
 @contextmanager
 def collect_problem():
+    _files.clear()
+    _mtimes.clear()
     _checkers.clear()
     _interactors.clear()
     _graders.clear()
     _headers.clear()
-    _ansfile.clear()
-    _matched_ansfile.clear()
+    _unmatched.clear()
     yield
     global __collected_problem
     __collected_problem = JudgeConf()
     cwd = os.getcwd()
-    for p in _ansfile:
-        warning(f"{repr(os.path.relpath(p, cwd))} 没有匹配输入文件，被忽略。", True)
-    for p in _matched_ansfile:
+    for p in _unmatched:
         warning(f"{repr(os.path.relpath(p, cwd))} 没有匹配输入文件，被忽略。", True)
     if _checkers:
         _checkers.sort(key=lambda x: os.stat(x).st_mtime_ns, reverse=True)
@@ -145,7 +299,6 @@ def collect_problem():
     _interactors.clear()
     _graders.clear()
     _headers.clear()
-    _ansfile.clear()
-    _matched_ansfile.clear()
+    _unmatched.clear()
 def collected_problem() -> JudgeConf:
     return __collected_problem
@@ -0,0 +1,239 @@
+"""
+内置的输出比较器，未配置校验器时代替 diff 使用，不需要编译和启动沙箱。
+
+比较方式（校验器配置 compare 项）：
+- lines：逐行比较，忽略行末空白字符和文件末尾缺少的换行（与 diff -Z --strip-trailing-cr 相同），默认；
+- wcmp：比较以空白字符分隔的单词序列；
+- ncmp：比较整数序列；
+- rcmp[:eps]：比较实数序列，绝对误差或相对误差不超过 eps 即视为相等，eps 默认为 1e-6。
+
+所有比较方式都以固定大小的块流式读取文件，内存占用与文件大小无关。压缩的答案文件边读取边解压。
+"""
+
+import math
+import os
+import re
+
+from .datafile import open_data
+
+TRUNK = 1 << 20
+# 报告不同之处时内容的最大显示长度
+PREVIEW = 32
+
+_INTEGER = re.compile(rb"-?(0|[1-9][0-9]*)")
+# 与 testlib 的 readDouble 接受的写法相同：不接受 nan、inf、下划线和十六进制
+_REAL = re.compile(rb"[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?")
+_SPACE = b" \t\r\v\f"
+_WHITESPACE = b" \t\n\r\v\f"
+_CLASSIFY = bytes(b" "[0] if i in _WHITESPACE else b"x"[0] for i in range(256))
+_TRAILING = (b" \n", b"\t\n", b"\r\n", b"\v\n", b"\f\n")
+
+def _preview(s: bytes | None):
+    if s is None:
+        return "文件末尾"
+    if len(s) > PREVIEW:
+        s = s[:PREVIEW] + b"..."
+    return repr(s.decode(errors="replace"))
+def _ordinal(n: int):
+    return f"第 {n} 个"
+
+def _skip_identical(out, ans, words: bool):
+    """
+    逐块跳过两个文件相同的前缀，并将两个文件定位到可以重新开始比较的位置：按行比较时是前缀中最后一个换行之后，按单词比较时是最后一个空白字符之后。
+    返回 (是否完全相同, 跳过的行数或单词数)。
+    """
+    safe = skipped = pos = 0
+    while True:
+        x = out.read(TRUNK)
+        y = ans.read(TRUNK)
+        if x != y:
+            break
+        if not x:
+            return True, 0
+        if words:
+            if (k := max(x.rfind(c) for c in _WHITESPACE)) != -1:
+                safe = pos + k + 1
+        elif (k := x.rfind(b"\n")) != -1:
+            skipped += x.count(b"\n")
+            safe = pos + k + 1
+        pos += len(x)
+    if words:
+        # 只有存在不同时才需要统计跳过的单词数：重新读取前缀，将字节分为空白和非空白两类后统计单词的开头
+        ans.seek(0)
+        prev = b" "
+        while n := min(TRUNK, safe - ans.tell()):
+            data = ans.read(n).translate(_CLASSIFY)
+            skipped += (prev + data).count(b" x")
+            prev = data[-1:]
+    out.seek(safe)
+    ans.seek(safe)
+    return False, skipped
+def _tokens(file):
+    """
+    按块读取文件并生成以空白字符分隔的单词列表，块边界上被截断的单词与下一块拼接。
+    """
+    rest = b""
+    while data := file.read(TRUNK):
+        words = (rest + data).split()
+        if data[-1:].isspace() or not words:
+            rest = b""
+        else:
+            rest = words.pop()
+        if words:
+            yield words
+    if rest:
+        yield [rest]
+
+def _normalized(file):
+    """
+    按块生成去掉行末空白字符的文件内容，文件末尾缺少的换行会被补上。块末尾的空白字符可能位于行末，留到下一块处理。
+    """
+    rest = b""
+    last = b"\n"
+    while data := file.read(TRUNK):
+        last = data[-1:]
+        data = rest + data
+        end = len(data.rstrip(_SPACE))
+        rest = data[end:]
+        data = data[:end]
+        if any(c in data for c in _TRAILING):
+            data = b"\n".join(s.rstrip(_SPACE) for s in data.split(b"\n"))
+        if data:
+            yield data
+    if last != b"\n":
+        yield b"\n"
+def _rest_of_line(s: bytes | None, it):
+    # 补足被块边界截断的内容以便显示
+    if s is None:
+        return None
+    while b"\n" not in s and len(s) <= PREVIEW and (t := next(it, None)) is not None:
+        s += t
+    return s.split(b"\n", 1)[0]
+def _lines(out, ans, line: int):
+    a = _normalized(out)
+    b = _normalized(ans)
+    x = y = b""
+    col = 1
+    while True:
+        # None 表示文件末尾
+        x = x or next(a, None)
+        y = y or next(b, None)
+        if x is None or y is None:
+            if x is None and y is None:
+                return "ac", ""
+            break
+        n = min(len(x), len(y))
+        if x[:n] == y[:n]:
+            k = n
+        else:
+            k = len(os.path.commonprefix([x[:n], y[:n]]))
+        # 跳过相同的部分并更新位置
+        same = x[:k]
+        if c := same.count(b"\n"):
+            line += c
+            col = k - same.rfind(b"\n")
+        else:
+            col += k
+        x = x[k:]
+        y = y[k:]
+        if k < n:
+            break
+    return "wa", f"第 {line} 行第 {col} 个字节起不同，期望 {_preview(_rest_of_line(y, b))}，得到 {_preview(_rest_of_line(x, a))}"
+def _words(out, ans, count: int, name: str, equal):
+    a = _tokens(out)
+    b = _tokens(ans)
+    xs = ys = []
+    i = j = 0
+    while True:
+        if i == len(xs):
+            xs, i = next(a, None), 0
+        if j == len(ys):
+            ys, j = next(b, None), 0
+        if xs is None or ys is None:
+            break
+        # 整段比较单词列表，只在不同时逐个比较
+        n = min(len(xs) - i, len(ys) - j)
+        if xs[i:i+n] == ys[j:j+n]:
+            i += n
+            j += n
+            count += n
+            continue
+        for _ in range(n):
+            x, y = xs[i], ys[j]
+            i += 1
+            j += 1
+            count += 1
+            if x != y and (msg := equal(x, y)) is not None:
+                return "wa", f"{_ordinal(count)}{name}不同，期望 {_preview(y)}，得到 {_preview(x)}{msg}"
+    if xs is None and ys is None:
+        return "ac", ""
+    if xs is None:
+        return "wa", f"{_ordinal(count + 1)}{name}缺失，期望 {_preview(ys[j])}，得到 {_preview(None)}"
+    return "wa", f"输出的{name}过多，{_ordinal(count + 1)}{name}为 {_preview(xs[i])}"
+
+# 以下函数比较两个不同的单词 x（输出）和 y（答案），视为相等时返回 None，否则返回附加在提示后的说明
+# 答案格式错误时引发 ValueError
+def _wcmp(x: bytes, y: bytes):
+    return ""
+def _ncmp(x: bytes, y: bytes):
+    if _INTEGER.fullmatch(x) is None:
+        return "（不是整数）"
+    if int(x) != int(y):
+        return ""
+    return None
+def _rcmp(eps: float):
+    def equal(x: bytes, y: bytes):
+        if _REAL.fullmatch(x) is None:
+            return "（不是实数）"
+        result = float(x)
+        expected = float(y)
+        if math.isnan(expected) or math.isnan(result):
+            return None if math.isnan(expected) and math.isnan(result) else ""
+        if math.isinf(expected) or math.isinf(result):
+            return None if expected == result else ""
+        # 与 testlib 的 doubleCompare 相同
+        if abs(result - expected) <= eps + 1e-15:
+            return None
+        lo = min(expected * (1 - eps), expected * (1 + eps))
+        hi = max(expected * (1 - eps), expected * (1 + eps))
+        if result + 1e-15 >= lo and result <= hi + 1e-15:
+            return None
+        return f"，误差 {abs(result - expected):.3g}"
+    return equal
+
+def parse_mode(mode: str):
+    """
+    解析比较方式，返回 (名称, 参数)，无效时引发 ValueError。
+    """
+    name, _, arg = mode.partition(":")
+    name = name.strip()
+    if name in ("lines", "wcmp", "ncmp"):
+        if arg:
+            raise ValueError(f"比较方式 {repr(name)} 没有参数。")
+        return name, None
+    if name == "rcmp":
+        try:
+            eps = float(arg) if arg else 1e-6
+        except ValueError:
+            raise ValueError(f"比较方式 rcmp 的误差 {repr(arg)} 无效。") from None
+        if not eps >= 0:
+            raise ValueError(f"比较方式 rcmp 的误差 {repr(arg)} 无效。")
+        return name, eps
+    raise ValueError(f"未知的比较方式 {repr(mode)}")
+def compare(outfile: str, ansfile: str, mode = "lines") -> tuple[str, str]:
+    """
+    比较选手输出文件和答案文件，返回 (结果, 附加信息)，结果是 ac 或 wa，附加信息说明第一处不同。
+    """
+    name, arg = parse_mode(mode)
+    with open(outfile, "rb") as out, open_data(ansfile) as ans:
+        # 大多数输出与答案完全相同或只有少量不同，先逐块比较字节，从第一处不同所在的行开始按比较方式比较
+        same, skipped = _skip_identical(out, ans, name != "lines")
+        if same:
+            return "ac", ""
+        if name == "lines":
+            return _lines(out, ans, skipped + 1)
+        if name == "wcmp":
+            return _words(out, ans, skipped, "单词", _wcmp)
+        if name == "ncmp":
+            return _words(out, ans, skipped, "整数", _ncmp)
+        return _words(out, ans, skipped, "实数", _rcmp(arg))
@@ -11,7 +11,7 @@ import time
 
 from .color import *
 
-CACHE_DISABLED = True
+CACHE_DISABLED = False
 
 DEBUG = False
 DEBUG_DS = False
@@ -111,6 +111,21 @@ def release_cpu(x: int, /):
             return
         file.write(x.to_bytes(4))
         fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+# 线程绑定的 CPU，由评测线程池的工作线程持有，线程内的沙箱优先使用
+_bound_cpu = threading.local()
+def bind_cpu(x: int, /):
+    _bound_cpu.cpu = x
+    _bound_cpu.busy = False
+def take_bound_cpu():
+    """
+    占用当前线程绑定的 CPU，没有绑定或者已被占用时返回 None。
+    """
+    if getattr(_bound_cpu, "cpu", -1) == -1 or _bound_cpu.busy:
+        return None
+    _bound_cpu.busy = True
+    return _bound_cpu.cpu
+def give_bound_cpu():
+    _bound_cpu.busy = False
 
 # 计时
 _ticket = []
@@ -0,0 +1,346 @@
+"""
+测试数据文件的读取。
+
+输入文件和答案文件可以是压缩文件（如 1.in.xz、1.ans.gz），收集测试点时去掉压缩后缀再配对。
+评测时不解压到磁盘：选手程序的标准输入、校验器和交互器读取的文件都是由解压线程写入的管道，内置比较器直接流式读取解压后的内容，内存占用与文件大小无关。
+zstd 压缩需要 Python 3.14 的 compression.zstd 模块或 zstandard 包，两者都不可用时忽略 .zst 文件。
+
+数据文件夹也可以是 zip 文件（例如备份得到的 .bak.zip），不需要解压，见 Archive。压缩包中的文件以 "<压缩包路径>/<成员名>" 的路径表示。
+"""
+
+import atexit
+import bz2
+import gzip
+import hashlib
+import io
+import lzma
+import mmap
+import os
+import select
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+
+from .utils import file_digest, file_digests, link_file
+
+TRUNK = 1 << 20
+
+try:
+    from compression import zstd as _zstd
+    _open_zstd = _zstd.open
+    _ZSTD_ERRORS = (_zstd.ZstdError, )
+except ImportError:
+    try:
+        import zstandard as _zstd
+        _open_zstd = _zstd.open
+        _ZSTD_ERRORS = (_zstd.ZstdError, )
+    except ImportError:
+        _open_zstd = None
+        _ZSTD_ERRORS = ()
+    else:
+        class _ZstdFile():
+            # zstandard 的解压流不能向后定位，向后定位时从头重新解压
+            def __init__(self, source, mode = "rb"):
+                self._source = source
+                self._file = self._open()
+            def _open(self):
+                return _zstd.open(self._source, "rb", closefd=isinstance(self._source, str))
+            def __enter__(self):
+                return self
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                self.close()
+            def read(self, size = -1):
+                return self._file.read(size)
+            def tell(self):
+                return self._file.tell()
+            def seek(self, offset: int):
+                if offset < self._file.tell():
+                    self._file.close()
+                    if not isinstance(self._source, str):
+                        self._source.seek(0)
+                    self._file = self._open()
+                return self._file.seek(offset)
+            def close(self):
+                self._file.close()
+        _open_zstd = _ZstdFile
+
+COMPRESSED_EXTS = {".gz": gzip.open, ".xz": lzma.open, ".bz2": bz2.open, ".zst": _open_zstd}
+# 读取损坏的压缩文件时可能产生的异常
+ERRORS = (OSError, EOFError, ValueError, lzma.LZMAError, zlib.error, zipfile.BadZipFile, *_ZSTD_ERRORS)
+
+class _View(io.RawIOBase):
+    # 内存中数据的只读流，读取时才复制需要的部分
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+    def readable(self):
+        return True
+    def seekable(self):
+        return True
+    def readinto(self, b):
+        n = len(data := self._view[self._pos:self._pos+len(b)])
+        b[:n] = data
+        self._pos += n
+        return n
+    def tell(self):
+        return self._pos
+    def seek(self, offset: int, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(offset, 0)
+        return self._pos
+
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+class Archive():
+    """
+    以只读方式挂载的 zip 文件。中心目录只读取一次并建立目录索引。
+    未压缩（stored）的成员直接使用整个文件的 mmap 的切片，不复制数据；压缩的成员通过 zipfile 流式解压。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        st = os.stat(path)
+        self.stamp = (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+        self.mtime = st.st_mtime_ns
+        self.zip = zipfile.ZipFile(path)
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.members: dict[str, zipfile.ZipInfo] = {}
+        self.dirs: dict[str, tuple[list[str], list[str]]] = {"": ([], [])}
+        for info in self.zip.infolist():
+            parts = [x for x in info.filename.split("/") if x not in ("", ".")]
+            # 不安全的成员名（绝对路径或包含 ..）不使用
+            if not parts or ".." in parts or info.filename.startswith("/"):
+                continue
+            name = "/".join(parts)
+            if info.is_dir():
+                self._add_dir(name)
+            elif name not in self.members:
+                self.members[name] = info
+                self.dirs[self._add_dir(os.path.dirname(name))][0].append(parts[-1])
+        self._digest = None
+        self._extracted = None
+        self._lock = threading.Lock()
+    def _add_dir(self, name: str):
+        if name not in self.dirs:
+            self.dirs[name] = ([], [])
+            self.dirs[self._add_dir(os.path.dirname(name))][1].append(os.path.basename(name))
+        return name
+    def view(self, member: str):
+        """
+        返回未压缩成员的内容（mmap 的切片），成员是压缩的时返回 None。
+        """
+        info = self.members[member]
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            return None
+        header = _LOCAL_HEADER.unpack_from(self._map, info.header_offset)
+        if header[0] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"压缩包 {repr(self.path)} 中 {repr(member)} 的文件头无效")
+        start = info.header_offset + _LOCAL_HEADER.size + header[9] + header[10]
+        return memoryview(self._map)[start:start+info.file_size]
+    def open(self, member: str):
+        if (view := self.view(member)) is not None:
+            return io.BufferedReader(_View(view), TRUNK)
+        return self.zip.open(self.members[member])
+    def digest(self, member: str):
+        """
+        成员内容的哈希。以压缩包的哈希（记录在文件哈希索引中）和成员名计算，不读取成员。
+        """
+        if self._digest is None:
+            self._digest = file_digest(self.path)
+        return hashlib.blake2b(f"{self._digest}/{member}".encode(), digest_size=32).hexdigest()
+    def extract(self, member: str):
+        """
+        将成员解压到临时目录并返回路径，用于需要真实文件的场合（如编译校验器）。同一目录中的成员解压到同一目录中。
+        """
+        with self._lock:
+            if self._extracted is None:
+                self._extracted = tempfile.mkdtemp(prefix="selfeval-archive-")
+                atexit.register(shutil.rmtree, self._extracted, True)
+            path = self.zip.extract(info := self.members[member], self._extracted)
+        os.utime(path, (t := time.mktime(info.date_time + (0, 0, -1)), t))
+        return path
+
+_archives: dict[str, Archive] = {}
+_archives_lock = threading.Lock()
+def mount(path: str):
+    """
+    挂载 zip 文件 path，文件变化时重新挂载。path 不是 zip 文件时返回 None。
+    """
+    path = os.path.abspath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    with _archives_lock:
+        if (archive := _archives.get(path)) is not None and archive.stamp == (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev):
+            return archive
+        if not zipfile.is_zipfile(path):
+            return None
+        try:
+            archive = _archives[path] = Archive(path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        return archive
+def archived(path: str) -> tuple[Archive, str] | None:
+    """
+    如果 path 位于已挂载的压缩包中，返回 (压缩包, 成员名)，压缩包本身的成员名是空字符串。
+    """
+    if not _archives:
+        return None
+    path = os.path.abspath(path)
+    for root, archive in list(_archives.items()):
+        if path == root:
+            return archive, ""
+        if path.startswith(root + os.sep):
+            return archive, path[len(root)+1:].replace(os.sep, "/")
+def listdir(path: str) -> tuple[list[str], list[str]] | None:
+    """
+    返回压缩包中的目录的 (文件名列表, 子目录名列表)，path 不是压缩包中的目录时返回 None。
+    """
+    if (x := archived(path)) is not None:
+        return x[0].dirs.get(x[1])
+def isdir(path: str):
+    """
+    判断 path 是否是目录，压缩包本身和其中的目录也视为目录。
+    """
+    if os.path.isdir(path):
+        return True
+    if (x := archived(path)) is None and mount(path) is not None:
+        x = archived(path)
+    return x is not None and x[1] in x[0].dirs
+def isfile(path: str):
+    if (x := archived(path)) is not None:
+        return x[1] in x[0].members
+    return os.path.isfile(path)
+def size(path: str):
+    """
+    返回数据文件（未解压）的大小。
+    """
+    if (x := archived(path)) is not None:
+        return x[0].members[x[1]].compress_size
+    return os.stat(path).st_size
+def real_path(path: str):
+    """
+    返回可以直接交给其它程序使用的路径，压缩包中的文件解压到临时目录。
+    """
+    if (x := archived(path)) is not None:
+        return x[0].extract(x[1])
+    return path
+def digests(paths: list[str]) -> list[str]:
+    """
+    返回多个数据文件的哈希，压缩包中的文件见 Archive.digest，其它文件见 utils.file_digests。
+    """
+    real = [path for path in paths if archived(path) is None]
+    ret = dict(zip(real, file_digests(real)))
+    return [ret[path] if path in ret else (x := archived(path))[0].digest(x[1]) for path in paths]
+
+def compression(path: str):
+    """
+    返回压缩文件的后缀（如 .xz），不是压缩文件时返回 None。
+    """
+    ext = os.path.splitext(path)[1]
+    return ext if ext in COMPRESSED_EXTS else None
+def supported(path: str):
+    """
+    判断是否可以读取文件，不支持的压缩格式返回 False。
+    """
+    return (ext := compression(path)) is None or COMPRESSED_EXTS[ext] is not None
+def strip(name: str):
+    """
+    去掉压缩后缀，得到用于配对的文件名。
+    """
+    return name[:-len(ext)] if (ext := compression(name)) is not None else name
+def is_plain(path: str):
+    """
+    判断文件是否可以直接使用（不需要解压，也不在压缩包中）。
+    """
+    return compression(path) is None and archived(path) is None
+def _source(path: str):
+    if (x := archived(path)) is not None:
+        return x[0].open(x[1])
+    return path
+def open_data(path: str):
+    """
+    以二进制只读方式打开数据文件，压缩文件返回解压后的流。
+    """
+    if (ext := compression(path)) is None:
+        return open(path, "rb") if (source := _source(path)) is path else source
+    if (opener := COMPRESSED_EXTS[ext]) is None:
+        raise OSError(f"无法读取 {repr(path)}，需要安装 zstandard。")
+    return opener(_source(path), "rb")
+def _chunks(path: str):
+    # 压缩包中未压缩的成员直接使用 mmap 的切片
+    if compression(path) is None and (x := archived(path)) is not None and (view := x[0].view(x[1])) is not None:
+        for i in range(0, len(view), TRUNK):
+            yield view[i:i+TRUNK]
+        return
+    with open_data(path) as fin:
+        while data := fin.read(TRUNK):
+            yield data
+def provide(path: str, dst: str):
+    """
+    将数据文件的内容提供到路径 dst：不需要解压时使用 link_file，否则解压到 dst。
+    """
+    if is_plain(path):
+        return link_file(path, dst)
+    with open(dst, "wb") as fout:
+        for data in _chunks(path):
+            fout.write(data)
+    return dst
+
+class DataStream():
+    """
+    通过管道提供数据文件的内容，path 是可以交给沙箱或校验器打开的路径。
+    不需要解压的文件直接使用原路径；否则由解压线程写入管道，读取端以 /proc/<pid>/fd/<fd> 的路径提供，数据不写入磁盘。
+    读取方没有读完就退出时，close 通知解压线程结束。解压失败时 error 是引发的异常。
+    """
+    def __init__(self, path: str):
+        self.src = path
+        self.error: BaseException | None = None
+        self._r = None
+        self._thread = None
+        self._stop = threading.Event()
+        if is_plain(path):
+            self.path = path
+            return
+        self._r, w = os.pipe2(os.O_CLOEXEC | os.O_NONBLOCK)
+        os.set_blocking(self._r, True)
+        self.path = f"/proc/{os.getpid()}/fd/{self._r}"
+        self._thread = threading.Thread(target=self._feed, args=(w, ), name="selfeval-feeder", daemon=True)
+        self._thread.start()
+    def _feed(self, w: int):
+        # 写入端是非阻塞的，管道满时定期检查是否需要结束，读取端的其它引用没有及时关闭也不会永久阻塞
+        poll = select.poll()
+        poll.register(w, select.POLLOUT)
+        try:
+            for data in _chunks(self.src):
+                view = memoryview(data)
+                while view:
+                    if self._stop.is_set():
+                        return
+                    try:
+                        view = view[os.write(w, view):]
+                    except BlockingIOError:
+                        poll.poll(100)
+        except BrokenPipeError:
+            pass
+        except ERRORS as err:
+            self.error = err
+        finally:
+            os.close(w)
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    def close(self):
+        if self._r is not None:
+            self._stop.set()
+            os.close(self._r)
+            self._r = None
+            self._thread.join()
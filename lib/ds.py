@@ -1,5 +1,6 @@
 import copy
 import decimal
+import io
 import json
 import os
 from types import GenericAlias, UnionType
@@ -8,6 +9,7 @@ from typing import Any, Callable
 import json5
 
 from .core import DEBUG_DS, error, warning
+from .datafile import open_data
 from .utils import sec, msec, MiB, tobool, totime, tomem, ftime, fmemory, stdopen
 
 class Program():
@@ -350,6 +352,7 @@ class JudgeConf(SimpleModel):
         limit: Limit = Limit(record_extra=True, record_invalid=True)
         safe: bool = False
         lang: str = "c++14:O2"
+        compare: str = "lines" # 未配置校验器时使用的内置比较方式，见 compare 模块
     class _InteractorConf(SimpleModel):
         safe: bool = False
         lang: str = "c++14:O2"
@@ -369,7 +372,8 @@ class JudgeConf(SimpleModel):
     additional: list[str] = []
     retry: int = 0
 def _read_conf(path: str):
-    with stdopen(path) as file:
+    # 配置文件可能位于压缩包中，见 datafile 模块
+    with io.TextIOWrapper(open_data(path), "utf-8") as file:
         try:
             data = json5.load(file)
         except json.JSONDecodeError as err:
@@ -378,8 +382,11 @@ def _read_conf(path: str):
     if isinstance(data, dict):
         return data
     error(f"测试点配置文件 {repr(path)} 无效：数据类型不是字典。", True)
-def read_test_conf(path: str):
-    if (data := _read_conf(path)) is None:
+def read_test_conf(path: str, data: dict = None):
+    """
+    读取测试点配置文件。提供 data 时使用它作为文件内容，不再读取文件。
+    """
+    if data is None and (data := _read_conf(path)) is None:
         return
     ret = TestConf.from_dict(data, True, True)
     for key, val in ret._record_extra:
@@ -398,13 +405,21 @@ def read_judge_conf(path: str):
     # TODO 更多检查
     return ret
 class Verdict():
-    def __init__(self, verdict: str = "", tm: int = 0, mem: int = 0, stat: int = 0, msg: str = "", score: decimal.Decimal = None):
+    def __init__(self, verdict: str = "", tm: int = 0, mem: int = 0, stat: int = 0, msg: str = "", score: decimal.Decimal = None, wall: int = 0, nvcsw: int = 0, nivcsw: int = 0, minflt: int = 0, majflt: int = 0, notif: int = 0):
         self.verdict = verdict
         self.tm = tm
         self.mem = mem
         self.stat = stat
         self.msg = msg
         self.score = score
+        # 沙箱报告的附加信息：墙上时间、主动和被动上下文切换次数、次要和主要缺页次数、seccomp 提醒次数
+        self.wall = wall
+        self.nvcsw = nvcsw
+        self.nivcsw = nivcsw
+        self.minflt = minflt
+        self.majflt = majflt
+        self.notif = notif
+        self.cached = False # 是否来自评测结果存储，见 verdicts 模块
     def __repr__(self):
         return f"Verdict({self.verdict}, {ftime(self.tm)}, {fmemory(self.mem)}, stat={self.stat}, msg={repr(self.msg)})"
 class Test():
@@ -412,3 +427,4 @@ class Test():
         self.tests = [] if tests is None else tests
         self.conf = TestConf() if conf is None else conf
         self.result: list[Verdict] = []
+        self.order: list[int] = None # 测试点的运行顺序，None 表示按原顺序，见 schedule 模块
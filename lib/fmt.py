@@ -41,6 +41,8 @@ class LiveStream():
         if ret.verdict == "pt":
             print(fmt_score(ret.score).toansi(), end=" ")
         print(fmt_verdict(ret.verdict).toansi(), end="")
+        if ret.cached:
+            print("", Gray("(缓存)").toansi(), end="")
         if ret.msg:
             print("", ret.msg, end="")
         print()
@@ -48,6 +50,12 @@ class LiveStream():
         while self.x < len(self.tests) and self.y == len(self.tests[self.x].tests):
             self.x += 1
             self.y = 0
+    def flush(self):
+        """
+        按顺序打印所有已经得到结果的测试点。
+        """
+        while not self.end() and self.y < len(self.tests[self.x].result):
+            self.println()
     def print_test(self):
         o = self.x
         while self.x == o:
@@ -1,26 +1,87 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import copy
 import decimal
+import functools
 import os
 import shutil
 import subprocess
+import threading
 
-from .core import DEBUG, error
+from . import userconf
+from .compare import compare
+from .core import cpus, acquire_cpu, release_cpu, bind_cpu, error, warning
+from .datafile import ERRORS, DataStream, is_plain, provide
 from .ds import Program, Limit, TestConf, JudgeConf, Verdict, Test
 from .fmt import LiveStream
-from .sandbox import run, run_interactive
-from .utils import sec, get_unique_path, is_xok, copy_to, cache_add, cache_get
+from .sandbox import SandboxGroup, SandboxBatch, current_group, run, run_interactive, async_run
+from .utils import sec, get_unique_path, is_xok, link_to, cache_add, cache_get
+from .verdicts import VerdictStore, identical
+from .workdir import acquire_workdir, release_workdir
 
 def _compile_cpp(cwd: str, source: str, output: str, graders: list[str], args: list[str]):
     return Program(output) if (ret := run(Program("g++", *args, source, *graders, "-o", output), Limit(time=sec(10)), cwd, stderr=None, trust=True)).verdict == "ok" else ret
 def _compile_cpp_makefile(cwd: str, usage: str):
     return Program(os.path.join(cwd, usage)) if (ret := run(Program("make", usage), Limit(time=sec(10)), cwd, stdout=None, stderr=None, trust=True)).verdict == "ok" else ret
-def compile_program(cwd: str, source: str, source_backup: str, lang: str, headers: list[str], graders: list[str], /, usage = "program"):
+@functools.cache
+def _compiler_info(name: str):
+    # 编译器更新后存档失效
+    if (path := shutil.which(name)) is None:
+        return name
+    st = os.stat(path)
+    return f"{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}"
+def _precompile_headers(cwd: str, headers: list[str], args: list[str]):
+    """
+    为 cwd 中的头文件生成预编译头 .gch，g++ 编译时自动使用。预编译头只在编译参数相同时有效，以头文件内容、编译参数和编译器版本为键缓存。
+    没有缓存的头文件在同一个事件循环中同时预编译。预编译失败时不影响编译，只是不使用预编译头。
+    """
+    key = ["-x", "c++-header", *args]
+    todo = []
+    for header in headers:
+        if os.path.isdir(header):
+            continue
+        name = os.path.basename(header)
+        pch = os.path.join(cwd, name + ".gch")
+        if _cache_get([header], key, "g++", pch) is None:
+            todo.append((header, name, pch))
+    if not todo:
+        return
+    async def precompile():
+        return await asyncio.gather(*(async_run(Program("g++", *key, name, "-o", pch), Limit(time=sec(30)), cwd, trust=True) for _, name, pch in todo))
+    for (header, name, pch), ret in zip(todo, asyncio.run(precompile())):
+        if ret.verdict == "ok":
+            _cache_add(Program(pch), [header], key, "g++")
+        else:
+            warning(f"无法为 {repr(header)} 生成预编译头。")
+            with contextlib.suppress(OSError):
+                os.remove(pch)
+def _cache_get(files: list[str], args: list[str], compiler: str, dst: str):
+    try:
+        if cache_get(files, args, _compiler_info(compiler), dst) is not None:
+            return Program(dst)
+    except Exception as err:
+        err.add_note("尝试读取缓存时发生异常。")
+        error(err)
+def _cache_add(ret: Program | Verdict, files: list[str], args: list[str], compiler: str):
+    if isinstance(ret, Program):
+        try:
+            cache_add(ret.prog, files, args, _compiler_info(compiler))
+        except Exception as err:
+            err.add_note("尝试创建缓存时发生异常。")
+            error(err)
+    return ret
+def compile_program(cwd: str, source: str, source_backup: str, lang: str, headers: list[str], graders: list[str], /, usage = "program", pch = False):
+    """
+    编译程序，成功时返回 Program，否则返回编译的运行结果或 None。pch 为真时为 headers 生成预编译头。
+    """
     wd = get_unique_path(cwd)
     os.mkdir(wd)
     for file in headers:
-        copy_to(file, wd)
+        link_to(file, wd)
     for file in graders:
-        copy_to(file, wd)
+        link_to(file, wd)
     if (x := lang.find(":")) != -1:
         typ = lang[:x]
         flags = lang[x+1:].split(",")
@@ -57,34 +118,46 @@ def compile_program(cwd: str, source: str, source_backup: str, lang: str, header
                     return Program(source)
                 if (source := source_backup) is None:
                     return
+            key = [source, p, *graders, *headers]
+            if (ret := _cache_get(key, ["make", usage], "make", os.path.join(wd, usage))) is not None:
+                return ret
             shutil.copyfile(p, os.path.join(wd, "Makefile"))
             shutil.copyfile(source, os.path.join(wd, usage + ".cpp"))
-            return _compile_cpp_makefile(wd, usage)
+            return _cache_add(_compile_cpp_makefile(wd, usage), key, ["make", usage], "make")
         else:
             if is_xok(source):
                 return Program(source)
-            try:
-                if (tmp := cache_get([source, *graders, *headers], args, "")) is not None:
-                    shutil.copy(tmp, p := get_unique_path(wd))
-                    os.remove(tmp)
-                    return Program(p)
-            except Exception as err:
-                err.add_note("尝试读取缓存时发生异常。")
-                error(err)
+            key = [source, *graders, *headers]
+            if (ret := _cache_get(key, args, "g++", get_unique_path(wd))) is not None:
+                return ret
+            if pch:
+                _precompile_headers(wd, headers, args)
             shutil.copyfile(source, p := os.path.join(wd, "a.cpp"))
-            ret = _compile_cpp(wd, p, get_unique_path(wd), graders, args)
-            if isinstance(ret, Program):
-                try:
-                    cache_add(ret.prog, [source, *graders, *headers], args, "")
-                except Exception as err:
-                    err.add_note("尝试创建缓存时发生异常。")
-                    error(err)
-            return ret
+            return _cache_add(_compile_cpp(wd, p, get_unique_path(wd), graders, args), key, args, "g++")
     # elif typ == "customized": # TODO 自定义编译
     #     pass
     else:
         error(f"未知的编程语言 {lang}")
 
+def _compile_task(group: SandboxGroup, cwd: str, usage: str, source: str, source_backup: str, lang: str, headers: list[str], graders: list[str], pch = False):
+    with group.bind():
+        return compile_program(cwd, source, source_backup, lang, headers, graders, usage, pch)
+def compile_programs(cwd: str, tasks: dict[str, tuple[str, str, str, list[str], list[str]] | tuple[str, str, str, list[str], list[str], bool]]):
+    """
+    同时编译多个程序，tasks 将 usage 映射到 compile_program 的其余参数。
+    按完成顺序生成 (usage, 编译结果)，提前结束迭代时终止其余正在进行的编译。
+    """
+    groups = {usage: SandboxGroup() for usage in tasks}
+    pool = concurrent.futures.ThreadPoolExecutor(len(tasks), "selfeval-compile")
+    try:
+        futures = {pool.submit(_compile_task, groups[usage], cwd, usage, *args): usage for usage, args in tasks.items()}
+        for fut in concurrent.futures.as_completed(futures):
+            yield futures[fut], fut.result()
+    finally:
+        for group in groups.values():
+            group.kill()
+        pool.shutdown(False, cancel_futures=True)
+
 def read_checklog(resp: Verdict, path: str, /, name = "校验器"):
     try:
         with open(path) as file:
@@ -130,85 +203,371 @@ def read_checklog(resp: Verdict, path: str, /, name = "校验器"):
         verdict = "fail"
         msg = name + "运行失败 " + repr(resp)
     return verdict, msg, score, normal
-def jury(cwd: str, prog: Program, testconf: TestConf, judgeconf: JudgeConf, infile: str, ansfile: str):
+class JuryRun():
+    """
+    评测的运行阶段得到的中间结果，由 jury_check 完成校验并调用 close 清理工作目录。
+    """
+    def __init__(self, ret: Verdict, wd: str, infile: str, ansfile: str, stdout: str, checklog: str = None, ret_interactor: Verdict = None, memfd: int = None):
+        self.ret = ret
+        self.wd = wd
+        self.infile = infile
+        self.ansfile = ansfile
+        self.stdout = stdout
+        self.checklog = checklog
+        self.ret_interactor = ret_interactor
+        self.memfd = memfd
+    def close(self):
+        release_workdir(self.wd)
+        if self.memfd is not None:
+            os.close(self.memfd)
+            self.memfd = None
+def jury_run(cwd: str, prog: Program, testconf: TestConf, judgeconf: JudgeConf, infile: str, ansfile: str, batch: SandboxBatch = None, store: VerdictStore = None) -> JuryRun:
+    """
+    评测的运行阶段：准备工作目录并运行选手程序（交互题同时运行交互器）。提供 batch 时选手程序在该批处理沙箱中运行（不适用于交互题）。
+    提供 store 时，使用并记录其中的输出存储。
+    """
     name = judgeconf.name
     retry = judgeconf.retry
+    # 需要硬链接到工作目录中的文件，见 acquire_workdir
+    links = (infile, *judgeconf.additional) if name and is_plain(infile) else tuple(judgeconf.additional)
     while True:
-        wd = get_unique_path(cwd)
-        os.mkdir(wd)
-        for file in judgeconf.additional:
-            copy_to(file, wd)
+        wd = acquire_workdir(cwd, testconf.limit.fsize, links)
+        memfd = None
+        # 输入文件和附加文件对选手程序只读，不复制数据，见 utils.link_file
         permissions = []
+        for file in judgeconf.additional:
+            link_to(file, wd)
+            permissions.append((os.path.join(wd, os.path.basename(file)), 0))
+        data = None
         if name:
             stdin = stdout = subprocess.DEVNULL
-            shutil.copyfile(infile, os.path.join(wd, name + ".in"))
+            provide(infile, os.path.join(wd, name + ".in"))
             permissions.append((os.path.join(wd, name + ".in"), 0))
             permissions.append((os.path.join(wd, name + ".out"), 1))
         else:
-            stdin = get_unique_path(wd)
-            shutil.copyfile(infile, stdin)
-            stdout = get_unique_path(wd)
+            # 标准输入直接使用原输入文件，压缩的输入文件由解压线程通过管道提供
+            data = DataStream(infile)
+            stdin = data.path
+            if not judgeconf.interactor and userconf.acquire_judge_memfd():
+                # 选手输出写入 memfd（大小同样受 fsize 限制），沙箱和校验器通过 /proc/<pid>/fd/<fd> 打开同一个 memfd，输出不经过磁盘
+                memfd = os.memfd_create("selfeval-stdout", os.MFD_CLOEXEC)
+                stdout = f"/proc/{os.getpid()}/fd/{memfd}"
+            else:
+                stdout = get_unique_path(wd)
             permissions.append((stdin, 0))
             permissions.append((stdout, 1))
+        checklog = ret_interactor = None
+        okey = None if store is None else store.output_key(testconf, infile)
+        loaded = False
         if (interactor := judgeconf.interactor):
             checklog = get_unique_path(wd)
             permissions.append((checklog, 1))
             ret, ret_interactor = run_interactive(prog, interactor, testconf.limit, wd, None, stdin, stdout, subprocess.DEVNULL, checklog, None, permissions, trust_interactor=judgeconf.checker_conf.safe)
+        elif okey is not None and (ret := store.load_output(okey, os.path.join(wd, name + ".out") if name else stdout)) is not None:
+            loaded = True
         else:
-            ret = run(prog, testconf.limit, wd, None, stdin, stdout, subprocess.DEVNULL, permissions)
+            if batch is None:
+                ret = run(prog, testconf.limit, wd, None, stdin, stdout, subprocess.DEVNULL, permissions)
+            else:
+                ret = batch.run(testconf.limit, wd, stdin, stdout, permissions)
+        if data is not None:
+            data.close()
+            if data.error is not None and not loaded:
+                ret.verdict = "fail"
+                ret.msg = "读取输入文件失败 " + str(data.error)
         if name:
             stdin = os.path.join(wd, name + ".in")
             stdout = os.path.join(wd, name + ".out")
+        state = JuryRun(ret, wd, infile, ansfile, stdout, checklog, ret_interactor, memfd)
         from .sandbox import TLE
-        if ret.verdict == "tl" and not (ret.stat & TLE) and retry > 0:
-            if not DEBUG:
-                shutil.rmtree(wd)
+        if ret.verdict == "tl" and not (ret.stat & TLE) and retry > 0 and not loaded:
+            state.close()
             retry -= 1
             continue
-        break
+        # 被终止的运行结果没有意义，不存储
+        if okey is not None and not loaded and not ((group := current_group()) is not None and group.killed):
+            store.save_output(okey, ret, stdout)
+        return state
+def jury_check(cwd: str, judgeconf: JudgeConf, state: JuryRun, store: VerdictStore = None) -> Verdict:
+    """
+    评测的校验阶段：运行校验器（或内置比较器）得到最终结果。可以在其它线程中与下一个测试点的运行阶段同时进行。
+    提供 store 时使用其中的校验结果缓存。
+    """
+    ret = state.ret
+    wd, infile, ansfile, stdout = state.wd, state.infile, state.ansfile, state.stdout
+    interactor = judgeconf.interactor
+    ret_interactor = state.ret_interactor
     from .sandbox import SIG, MLE, OLE, FBD
     if interactor and (ret_interactor.stat & (SIG | MLE | OLE | FBD)):
         ret.verdict = "fail"
         ret.msg = "交互器运行失败 " + repr(ret_interactor)
     elif interactor and ret_interactor.verdict != "ok":
-        ret.verdict, ret.msg, ret.score, _ = read_checklog(ret_interactor, checklog, "交互器")
+        ret.verdict, ret.msg, ret.score, _ = read_checklog(ret_interactor, state.checklog, "交互器")
         if not _ or ret.verdict == "wa":
             ret.verdict = "il"
     elif ret.verdict == "ok":
         checker: Program = copy.deepcopy(judgeconf.checker)
         lim = judgeconf.checker_conf.limit
         if checker is None:
-            resp = run(Program("diff", "-Z", "-q", "--strip-trailing-cr", stdout, ansfile), lim, cwd, trust=True)
-            from .sandbox import EXIT
-            if resp.verdict == "re" and (resp.stat ^ EXIT) == 1:
-                ret.verdict = "wa"
-            elif resp.verdict == "ok":
-                ret.verdict = "ac"
-            else:
+            try:
+                ret.verdict, ret.msg = compare(stdout, ansfile, judgeconf.checker_conf.compare)
+            except ERRORS as err:
                 ret.verdict = "fail"
-                ret.msg = "diff 运行失败 " + repr(resp)
+                ret.msg = "比较输出失败 " + str(err)
         else:
-            checklog = get_unique_path(wd)
-            checker.args += [infile, stdout, ansfile]
-            resp = run(checker, lim, cwd, stderr=checklog, permissions=[(infile, 0), (stdout, 0), (ansfile, 0), (checklog, 1)], trust=judgeconf.checker_conf.safe)
-            ret.verdict, ret.msg, ret.score, _ = read_checklog(resp, checklog)
-    if not DEBUG:
-        shutil.rmtree(wd)
+            same = out = ckey = None
+            try:
+                # 输出与答案完全相同时直接判为正确，不运行校验器
+                if userconf.acquire_judge_identical_ac():
+                    same, out = identical(stdout, ansfile)
+                if not same and store is not None:
+                    ckey = store.check_key(infile, stdout, ansfile, out)
+            except OSError:
+                pass
+            if same:
+                ret.verdict, ret.msg = "ac", "输出与答案相同"
+            elif (x := store.get_check(ckey) if ckey is not None else None) is not None:
+                ret.verdict, ret.msg, ret.score = x
+            else:
+                checklog = get_unique_path(wd)
+                with DataStream(infile) as fin, DataStream(ansfile) as fans:
+                    checker.args += [fin.path, stdout, fans.path]
+                    resp = run(checker, lim, cwd, stderr=checklog, permissions=[(fin.path, 0), (stdout, 0), (fans.path, 0), (checklog, 1)], trust=judgeconf.checker_conf.safe)
+                if (err := fin.error or fans.error) is not None:
+                    ret.verdict = "fail"
+                    ret.msg = "读取数据失败 " + str(err)
+                else:
+                    ret.verdict, ret.msg, ret.score, _ = read_checklog(resp, checklog)
+                    if ckey is not None:
+                        store.put_check(ckey, ret.verdict, ret.msg, ret.score)
+    state.close()
     return ret
-def jury_test(cwd: str, prog: Program, testconf: TestConf, conf: JudgeConf, test: Test, live: LiveStream = None):
+def jury(cwd: str, prog: Program, testconf: TestConf, judgeconf: JudgeConf, infile: str, ansfile: str, batch: SandboxBatch = None, store: VerdictStore = None):
+    """
+    评测一个测试点。提供 batch 时选手程序在该批处理沙箱中运行（不适用于交互题）。提供 store 时使用其中的输出存储和校验结果缓存。
+    """
+    return jury_check(cwd, judgeconf, jury_run(cwd, prog, testconf, judgeconf, infile, ansfile, batch, store), store)
+def _failed(ret: Verdict):
+    return ret.verdict not in ("ac", "ig") and (ret.verdict != "pt" or ret.score <= 0)
+def jury_test(cwd: str, prog: Program, testconf: TestConf, conf: JudgeConf, test: Test, live: LiveStream = None, store: VerdictStore = None):
+    """
+    串行运行一个子任务的测试点。有空闲 CPU 时校验阶段交给校验线程，与下一个测试点的运行阶段重叠，结果仍按顺序输出到 live。
+    提供 store 时，已有评测结果的测试点不再运行。
+    """
     if test.conf:
         testconf.update(test.conf)
-    jump = False
-    for tc in test.tests:
-        if jump:
-            test.result.append(Verdict(verdict="ig"))
+    # 同一子任务的多个测试点使用同一个批处理沙箱运行选手程序
+    if userconf.acquire_judge_batch() and not conf.interactor and len(test.tests) > 1:
+        ctx = SandboxBatch(prog.prog, prog.args, cwd, prog.env, subprocess.DEVNULL, userconf.acquire_judge_isolate())
+    else:
+        ctx = contextlib.nullcontext()
+    # 开启评测隔离时，只有一个 CPU 则选手程序和校验器无法同时运行
+    if len(test.tests) > 1 and (not userconf.acquire_judge_isolate() or len(cpus) > 1):
+        checker = concurrent.futures.ThreadPoolExecutor(1, "selfeval-check")
+    else:
+        checker = contextlib.nullcontext()
+    st = _Subtask(test, testconf, store)
+    pending: collections.deque[tuple[int, concurrent.futures.Future]] = collections.deque()
+    def check(i: int, state: JuryRun):
+        ret = jury_check(cwd, conf, state, store)
+        st.cancel_after(i, ret)
+        return ret
+    def collect(depth: int):
+        # 校验线程按提交顺序完成，等待到只剩 depth 个未完成的校验，再收集所有已完成的
+        while pending and (len(pending) > depth or pending[0][1].done()):
+            i, fut = pending.popleft()
+            st.settle(i, fut.result())
             if live:
-                live.println()
-            continue
-        ret = jury(cwd, prog, testconf, conf, tc[0], tc[1])
-        test.result.append(ret)
-        if ret.verdict != "ac" and (ret.verdict != "pt" or ret.score <= 0):
-            if not testconf.keep:
-                jump = True
-        if live:
-            live.println()
+                live.flush()
+    with ctx as batch, checker as pool:
+        started = False
+        # 测试点可能不按原顺序运行（见 schedule 模块），结果仍按原顺序记录
+        for i in range(len(test.tests)) if test.order is None else test.order:
+            infile, ansfile = test.tests[i]
+            if st.jump:
+                break
+            # 存储的结果不需要运行就能得到，即使测试点已经被终止也照常记录
+            if (ret := st.cached(i)) is not None:
+                st.settle(i, ret)
+                if live:
+                    live.flush()
+                continue
+            # 测试点失败时，校验线程会通过 SandboxGroup 终止应当忽略的选手程序
+            if not st.start(i):
+                st.settle(i, Verdict(verdict="ig"))
+                continue
+            group = st.groups[i]
+            # 所有测试点都有评测结果时不需要启动批处理沙箱
+            if batch is not None and not started:
+                batch.start()
+                started = True
+            with group.bind():
+                if batch is not None:
+                    group.add(batch)
+                try:
+                    state = jury_run(cwd, prog, testconf, conf, infile, ansfile, batch, store)
+                finally:
+                    if batch is not None:
+                        group.discard(batch)
+            if pool is None:
+                st.settle(i, jury_check(cwd, conf, state, store))
+                if live:
+                    live.flush()
+            else:
+                pending.append((i, pool.submit(check, i, state)))
+                collect(1) # 选手程序最多领先校验器一个测试点
+        collect(0)
+    while len(test.result) < len(test.tests):
+        test.result.append(Verdict(verdict="ig"))
+    if live:
+        live.flush()
+
+class JuryPool(concurrent.futures.ThreadPoolExecutor):
+    """
+    评测线程池。开启评测隔离时，每个工作线程通过 acquire_cpu 独占一个 CPU，线程内的沙箱优先使用该 CPU，线程池关闭时统一释放。
+    提供 prog 时，每个工作线程第一次调用 batch 时为 prog 启动一个批处理沙箱，之后该线程的测试点都在其中运行，线程池关闭时统一关闭。
+    """
+    def __init__(self, jobs: int, prog: Program = None, cwd: str = None):
+        self._cpus: list[int] = []
+        self._cpus_lock = threading.Lock()
+        self._prog = prog
+        self._cwd = cwd
+        self._local = threading.local()
+        self._batches: list[SandboxBatch] = []
+        super().__init__(jobs, "selfeval-jury", self._init_worker)
+    def _init_worker(self):
+        if not userconf.acquire_judge_isolate():
+            return
+        if (cpu := acquire_cpu()) == -1:
+            warning("评测线程无可用 CPU，将由沙箱自行分配。")
+            return
+        with self._cpus_lock:
+            self._cpus.append(cpu)
+        self._local.cpu = cpu
+        bind_cpu(cpu)
+    def batch(self) -> SandboxBatch | None:
+        """
+        返回当前工作线程的批处理沙箱，没有提供 prog 时返回 None。
+        """
+        if self._prog is None:
+            return
+        if (batch := getattr(self._local, "batch", None)) is None:
+            # 同一线程的选手程序和校验器依次运行，批处理沙箱使用线程的 CPU 但不占用，校验器仍然可以使用
+            batch = SandboxBatch(self._prog.prog, self._prog.args, self._cwd, self._prog.env, subprocess.DEVNULL, userconf.acquire_judge_isolate(), cpu=getattr(self._local, "cpu", None))
+            with self._cpus_lock:
+                self._batches.append(batch)
+            batch.start()
+            self._local.batch = batch
+        return batch
+    def shutdown(self, wait = True, *, cancel_futures = False):
+        super().shutdown(wait, cancel_futures=cancel_futures)
+        if wait:
+            with self._cpus_lock:
+                batches, self._batches = self._batches, []
+            for batch in batches:
+                batch.__exit__(None, None, None)
+            with self._cpus_lock:
+                for cpu in self._cpus:
+                    release_cpu(cpu)
+                self._cpus.clear()
+class _Subtask():
+    """
+    按测试点顺序收集乱序完成的评测结果。未设置 keep 时，首个失败的测试点之后的结果均记为 ig，与串行评测相同。
+    子任务设置了运行顺序（见 schedule 模块）时同样如此：测试点失败只终止原顺序中在它之后的测试点，之前的测试点仍然运行。
+    提供 store 时，从中查找测试点的评测结果，并记录新得到的结果和测试点历史。
+    """
+    def __init__(self, test: Test, testconf: TestConf, store: VerdictStore = None):
+        self.test = test
+        self.testconf = testconf
+        self.store = store
+        self.jump = False
+        self.groups = [SandboxGroup() for _ in test.tests]
+        self._pending: dict[int, Verdict] = {}
+        self._keys: dict[int, str | None] = {}
+        self._lock = threading.Lock()
+    def start(self, i: int):
+        """
+        测试点开始运行前调用，已经被终止时返回 False。
+        """
+        with self._lock:
+            return not self.groups[i].killed
+    def cached(self, i: int):
+        if self.store is None:
+            return
+        infile, ansfile = self.test.tests[i]
+        self._keys[i] = key = self.store.key(self.testconf, infile, ansfile)
+        return self.store.get(key)
+    def cancel_after(self, i: int, ret: Verdict):
+        if _failed(ret) and not self.testconf.keep:
+            # 无论之前的测试点结果如何，之后的测试点都会被忽略，可以立即终止
+            with self._lock:
+                for group in self.groups[i + 1:]:
+                    group.kill()
+    def settle(self, i: int, ret: Verdict):
+        self.cancel_after(i, ret)
+        # 被终止的测试点的结果没有意义，不记录历史
+        if self.store is not None and not self.groups[i].killed:
+            self.store.record(self.test.tests[i][0], ret)
+        self._pending[i] = ret
+        result = self.test.result
+        while (j := len(result)) in self._pending:
+            ret = self._pending.pop(j)
+            if self.jump:
+                ret = Verdict(verdict="ig")
+            else:
+                if self.store is not None and not ret.cached and j in self._keys:
+                    self.store.put(self._keys[j], ret)
+                if _failed(ret) and not self.testconf.keep:
+                    self.jump = True
+            result.append(ret)
+def _jury_task(pool: JuryPool, st: _Subtask, i: int, cwd: str, prog: Program, testconf: TestConf, conf: JudgeConf, infile: str, ansfile: str, store: VerdictStore = None):
+    if not st.start(i):
+        return Verdict(verdict="ig")
+    batch = pool.batch()
+    group = st.groups[i]
+    with group.bind():
+        if batch is None:
+            return jury(cwd, prog, testconf, conf, infile, ansfile, None, store)
+        group.add(batch)
+        try:
+            state = jury_run(cwd, prog, testconf, conf, infile, ansfile, batch, store)
+        finally:
+            group.discard(batch)
+        return jury_check(cwd, conf, state, store)
+def jury_tests(cwd: str, prog: Program, testconf: TestConf, conf: JudgeConf, tests: list[Test], live: LiveStream = None, jobs = 1, store: VerdictStore = None):
+    """
+    使用 jobs 个工作线程并行评测所有测试点，结果按测试点顺序输出到 live。提供 store 时，已有评测结果的测试点不再运行。
+    每个工作线程使用各自的批处理沙箱运行选手程序（不适用于交互题）。
+    """
+    if userconf.acquire_judge_isolate() and jobs > len(cpus):
+        warning(f"并行评测数 {jobs} 超过 CPU 核心数 {len(cpus)}，已调整为 {len(cpus)}。")
+        jobs = len(cpus)
+    subtasks: list[_Subtask] = []
+    for test in tests:
+        tc = copy.deepcopy(testconf)
+        if test.conf:
+            tc.update(test.conf)
+        subtasks.append(_Subtask(test, tc, store))
+    with JuryPool(jobs, prog if userconf.acquire_judge_batch() and not conf.interactor else None, cwd) as pool:
+        futures = {}
+        try:
+            for st in subtasks:
+                for i in range(len(st.test.tests)) if st.test.order is None else st.test.order:
+                    infile, ansfile = st.test.tests[i]
+                    if (ret := st.cached(i)) is not None:
+                        st.settle(i, ret)
+                        if live:
+                            live.flush()
+                    else:
+                        futures[pool.submit(_jury_task, pool, st, i, cwd, prog, st.testconf, conf, infile, ansfile, store)] = (st, i)
+            for fut in concurrent.futures.as_completed(futures):
+                st, i = futures[fut]
+                st.settle(i, fut.result())
+                if live:
+                    live.flush()
+        except BaseException:
+            pool.shutdown(False, cancel_futures=True)
+            for st in subtasks:
+                for group in st.groups:
+                    group.kill()
+            raise
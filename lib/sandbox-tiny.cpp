@@ -1,4 +1,8 @@
-#include <fstream>
+#include <fcntl.h>
+#include <iostream>
+#include <string.h>
+#include <time.h>
+#include <string>
 #include <sys/resource.h>
 #include <sys/time.h>
 #include <sys/wait.h>
@@ -69,18 +73,28 @@ static inline int tracer() {
 }
 
 bool child_overdue;
+time_t run_time, wall_time;
+int result_fd = -1; // 向 sandbox.py 发送结果记录的文件描述符，子进程不应继承
 
-int main(int argc, char *argv[]) {
-    pid = fork();
-    char *prog_path = argv[1];
-    char *output = argv[2];
-    time_limit = atol(argv[3]);
-    mem_limit = atol(argv[4]);
-    stack_limit = atol(argv[5]);
-    fsize_limit = atol(argv[6]);
-    // argv[7] 是 cpuset 的二进制掩码
-    int file_cnt = atoi(argv[8]);
-    int args_st = 9 + (file_cnt << 1);
+static inline time_t monotonic() {
+    timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec * 1000000 + t.tv_nsec / 1000;
+}
+
+static inline void redirect(const char *path, int fd, int flags) {
+    // 空路径表示 /dev/null
+    int x = open(*path ? path : "/dev/null", flags, 0644);
+    if (x == -1) {
+        perror("open");
+        _exit(128);
+    }
+    dup2(x, fd);
+    close(x);
+}
+// 运行一次程序，返回运行状态，-1 表示沙箱出错
+// in_path 为空指针时沿用沙箱的标准输入输出，并在子进程准备好后挂起沙箱等待进一步指令；否则是批处理模式，不挂起
+static inline int run_job(char *prog_path, char **args, const char *cpuset, const char *in_path, const char *out_path) {
     itimerval it;
     it.it_value.tv_sec = time_limit / 1000000;
     it.it_value.tv_usec = time_limit % 1000000;
@@ -88,50 +102,127 @@ int main(int argc, char *argv[]) {
     struct sigaction sa;
     sigemptyset(&sa.sa_mask);
     sa.sa_flags = 0;
+    child_overdue = false;
+    pid = fork();
     if (pid == 0) {
         pid = getpid();
-        char **args = new char *[argc - args_st + 2];
-        args[0] = prog_path;
-        for (int i = args_st; i < argc; ++i)
-            args[i - args_st + 1] = argv[i];
-        args[argc - args_st + 1] = nullptr;
+        if (result_fd != STDOUT_FILENO)
+            close(result_fd);
+        if (in_path != nullptr) {
+            redirect(in_path, STDIN_FILENO, O_RDONLY);
+            redirect(out_path, STDOUT_FILENO, O_WRONLY | O_CREAT | O_TRUNC);
+        }
         cpu_set_t mask;
         CPU_ZERO(&mask);
-        for (int i = 0; argv[7][i]; ++i)
-            if (argv[7][i] == '1')
+        for (int i = 0; cpuset[i]; ++i)
+            if (cpuset[i] == '1')
                 CPU_SET(i, &mask);
         sched_setaffinity(pid, sizeof(mask), &mask);
+        signal(SIGALRM, SIG_DFL); // 批处理模式下沙箱忽略 SIGALRM，忽略的信号会被 exec 继承
         kill(pid, SIGSTOP);
         apply_rlimit();
         execv(prog_path, args);
         perror("execv");
-        delete[] args;
-        return 128;
-    } else if (pid > 0) {
-        child_pid = pid;
-        pid = getpid();
-        it.it_value.tv_sec += 1;
-        sa.sa_handler = [](int sig) {
-            if (sig == SIGALRM && child_pid > 0) {
-                kill(child_pid, SIGKILL);
-                child_overdue = true;
-            }
-        };
-        sigaction(SIGALRM, &sa, nullptr);
-        wait4(child_pid, &status, WUNTRACED, &usage);
-        start_time = trans(usage);
+        _exit(128);
+    } else if (pid < 0)
+        return -1;
+    child_pid = pid;
+    pid = getpid();
+    it.it_value.tv_sec += 1;
+    sa.sa_handler = [](int sig) {
+        if (sig == SIGALRM && child_pid > 0) {
+            kill(child_pid, SIGKILL);
+            child_overdue = true;
+        }
+    };
+    sigaction(SIGALRM, &sa, nullptr);
+    wait4(child_pid, &status, WUNTRACED, &usage);
+    start_time = trans(usage);
+    if (in_path == nullptr) {
+        write_ready(result_fd);
         kill(pid, SIGSTOP); // 挂起等待进一步指令
-        kill(child_pid, SIGCONT);
-        setitimer(ITIMER_REAL, &it, nullptr);
-        int ret = tracer();
-        if (child_overdue)
-            ret = TLE | TLE_OVERDUE;
-        std::ofstream out(output, std::ios::out);
-        out << trans(usage) - start_time << '\n';
-        out << (usage.ru_maxrss << 10) << '\n';
-        out << ret << '\n';
-        out.close();
-        return 0;
-    } else
+    }
+    kill(child_pid, SIGCONT);
+    setitimer(ITIMER_REAL, &it, nullptr);
+    time_t wall_start = monotonic();
+    int ret = tracer();
+    wall_time = monotonic() - wall_start;
+    it.it_value.tv_sec = it.it_value.tv_usec = 0;
+    setitimer(ITIMER_REAL, &it, nullptr);
+    child_pid = 0;
+    if (child_overdue)
+        ret = TLE | TLE_OVERDUE;
+    run_time = trans(usage) - start_time;
+    return ret;
+}
+static inline bool write_result(int fd, int ret) {
+    result_t res;
+    memset(&res, 0, sizeof(res));
+    res.status = ret;
+    if (ret != -1) {
+        res.time = run_time;
+        res.memory = usage.ru_maxrss << 10;
+        res.wall_time = wall_time;
+        res.nvcsw = usage.ru_nvcsw;
+        res.nivcsw = usage.ru_nivcsw;
+        res.minflt = usage.ru_minflt;
+        res.majflt = usage.ru_majflt;
+    }
+    return write_record(fd, res, nullptr, 0);
+}
+
+// 批处理模式，格式见 sandbox.cpp
+static inline int batch(char *argv[]) {
+    char *prog_path = argv[2];
+    char **args = argv + 2;
+    std::string cwd, in_path, out_path, cpuset, s;
+    result_fd = STDOUT_FILENO;
+    // 任务之间没有子进程需要杀死，忽略 SIGALRM（沙箱组可能随时终止任务），否则会终止沙箱或中断任务的读取
+    signal(SIGALRM, SIG_IGN);
+    while (std::getline(std::cin, cwd) && std::getline(std::cin, in_path) && std::getline(std::cin, out_path)) {
+        try {
+            std::getline(std::cin, s), time_limit = std::stol(s);
+            std::getline(std::cin, s), mem_limit = std::stol(s);
+            std::getline(std::cin, s), stack_limit = std::stol(s);
+            std::getline(std::cin, s), fsize_limit = std::stol(s);
+            std::getline(std::cin, cpuset);
+            std::getline(std::cin, s);
+            for (int i = std::stoi(s) * 2; i > 0; --i) // 不检查文件权限
+                std::getline(std::cin, s);
+        } catch (const std::exception &e) {
+            std::cerr << "invalid job: " << e.what() << std::endl;
+            return 1;
+        }
+        // 切换到任务的工作目录，子进程会继承，检查权限时解析相对路径也依赖于此
+        int ret = chdir(cwd.c_str()) == 0 ? run_job(prog_path, args, cpuset.c_str(), in_path.c_str(), out_path.c_str()) : -1;
+        if (!write_result(result_fd, ret))
+            return 1;
+        signal(SIGALRM, SIG_IGN);
+    }
+    return 0;
+}
+
+int main(int argc, char *argv[]) {
+    if (argc > 2 && strcmp(argv[1], "--batch") == 0)
+        return batch(argv);
+    char *prog_path = argv[1];
+    result_fd = atoi(argv[2]); // argv[2] 是结果记录的文件描述符
+    time_limit = atol(argv[3]);
+    mem_limit = atol(argv[4]);
+    stack_limit = atol(argv[5]);
+    fsize_limit = atol(argv[6]);
+    // argv[7] 是 cpuset 的二进制掩码
+    int file_cnt = atoi(argv[8]);
+    int args_st = 9 + (file_cnt << 1);
+    char **args = new char *[argc - args_st + 2];
+    args[0] = prog_path;
+    for (int i = args_st; i < argc; ++i)
+        args[i - args_st + 1] = argv[i];
+    args[argc - args_st + 1] = nullptr;
+    int ret = run_job(prog_path, args, argv[7], nullptr, nullptr);
+    delete[] args;
+    if (ret == -1 || !write_result(result_fd, ret))
         return 128;
-}
\ No newline at end of file
+    close(result_fd);
+    return 0;
+}
@@ -4,16 +4,17 @@ sandbox.cpp
 时间单位是微秒，空间单位是字节。
 */
 
+#include <algorithm>
 #include <fcntl.h>
 #include <filesystem>
-#include <fstream>
 #include <iostream>
+#include <linux/audit.h>
 #include <linux/filter.h>
 #include <linux/seccomp.h>
 #include <poll.h>
-#include <regex>
 #include <seccomp.h>
 #include <signal.h>
+#include <sstream>
 #include <string.h>
 #include <string>
 #include <sys/ioctl.h>
@@ -63,52 +64,54 @@ static inline void apply_rlimit() {
     setlimit(RLIMIT_FSIZE, (rlim_t)fsize_limit);
 }
 
-#define TRUNK 128
+// 读取子进程内存中的字符串
+// 每次读到页边界为止（跨页读取可能因为下一页未映射而失败），路径通常一次系统调用即可读完
 std::string read_string(long addr) {
+    static const long page_size = sysconf(_SC_PAGESIZE);
     std::string result;
-    char buffer[TRUNK];
-    struct iovec local_iov = {
-        .iov_base = buffer,
-        .iov_len = TRUNK,
-    };
-    struct iovec remote_iov = {
-        .iov_base = nullptr,
-        .iov_len = TRUNK,
-    };
+    char buffer[4096];
     for (;;) {
-        remote_iov.iov_base = (void *)addr;
+        size_t len = std::min((size_t)(page_size - addr % page_size), sizeof(buffer));
+        struct iovec local_iov = {
+            .iov_base = buffer,
+            .iov_len = len,
+        };
+        struct iovec remote_iov = {
+            .iov_base = (void *)addr,
+            .iov_len = len,
+        };
         ssize_t bytes_read = process_vm_readv(child_pid, &local_iov, 1, &remote_iov, 1, 0);
         if (bytes_read <= 0)
             break;
-        int null_pos = -1;
-        for (int i = 0; i < bytes_read; ++i)
-            if (buffer[i] == '\0') {
-                null_pos = i;
-                break;
-            }
-        if (null_pos == -1) {
-            result.append(buffer, buffer + TRUNK);
-            addr += bytes_read;
-        } else {
-            result.append(buffer, buffer + null_pos);
+        if (auto end = (char *)memchr(buffer, '\0', (size_t)bytes_read); end != nullptr) {
+            result.append(buffer, end);
             break;
         }
+        result.append(buffer, (size_t)bytes_read);
+        addr += bytes_read;
     }
     return result;
 }
-#undef TRUNK
 fs::path child_dirfd_path;
 typedef std::pair<dev_t, ino64_t> identity_t;
 const identity_t identity_null{-1, -1};
 struct hs_type {
-    inline size_t operator()(const std::pair<identity_t, std::string> &x) const {
-        return x.first.second;
+    inline size_t operator()(const identity_t &x) const {
+        return std::hash<ino64_t>()(x.second) * 31 + x.first;
     }
-    inline size_t operator()(const std::pair<std::string, int> &x) const {
-        return (size_t)(&x.first);
+    inline size_t operator()(const std::pair<identity_t, std::string> &x) const {
+        size_t h = (*this)(x.first);
+        return h ^ (std::hash<std::string>()(x.second) + 0x9e3779b97f4a7c15 + (h << 6) + (h >> 2));
     }
 };
+// 以 (父目录的设备号和 inode 号, 文件名) 为键的权限，文件本身可以不存在
 std::unordered_map<std::pair<identity_t, std::string>, int, hs_type> files_permission;
+// 目录的判定缓存：目录中的文件从该目录及其祖先目录的权限得到的可满足的访问方式（按 acc 的位掩码），权限变化时需要清空
+// 文件本身的权限按 (父目录, 文件名) 授予，同一文件（例如硬链接）经由不同路径访问时权限可以不同，因此不按文件缓存
+std::unordered_map<identity_t, int, hs_type> dir_verdict;
+static inline void clear_verdicts() {
+    dir_verdict.clear();
+}
 struct {
     int active;
     fs::path p, ori;
@@ -127,31 +130,65 @@ static inline void add_permission(const fs::path &path, int acc) {
     // cerr << "add permission(" << acc << ") " << path << endl;
     if (auto id = get_identity(fs::canonical(path.parent_path())); id != identity_null)
         files_permission[{id, path.filename()}] |= acc;
+    clear_verdicts();
+}
+// 一项权限可以满足的访问方式：(acc & perm) == acc 的 acc 组成的位掩码
+static inline int satisfied(const identity_t &dir, const std::string &name) {
+    auto it = files_permission.find({dir, name});
+    if (it == files_permission.end())
+        return 0;
+    int mask = 0;
+    for (int acc = 0; acc < 4; ++acc)
+        if ((acc & it->second) == acc)
+            mask |= 1 << acc;
+    return mask;
+}
+static inline int dir_mask(const fs::path &dir, const identity_t &id) {
+    if (auto it = dir_verdict.find(id); it != dir_verdict.end())
+        return it->second;
+    // 未缓存时解析真实路径，从根目录逐层计算，沿途的目录一并缓存
+    // 每个目录只需解析一次，之后目录中的文件只需一次 stat 和两次查表
+    std::error_code ec;
+    auto real = fs::canonical(dir, ec);
+    if (ec)
+        return 0;
+    fs::path p = "/";
+    auto cur = get_identity(p);
+    int mask = 0;
+    dir_verdict.emplace(cur, mask);
+    for (const auto &name : real.relative_path()) {
+        mask |= satisfied(cur, name);
+        cur = get_identity(p /= name);
+        dir_verdict.emplace(cur, mask);
+    }
+    return dir_verdict[id] = mask;
+}
+static inline int path_mask(const fs::path &path) {
+    // 父目录不存在时按最近的存在的祖先目录判断，此时系统调用本身会失败
+    fs::path parent = path.parent_path(), name = path.filename();
+    identity_t id;
+    while ((id = get_identity(parent)) == identity_null && parent != parent.parent_path())
+        name = parent.filename(), parent = parent.parent_path();
+    return id == identity_null ? 0 : dir_mask(parent, id) | satisfied(id, name);
 }
-std::unordered_set<std::string> _is_permitted_cache[4];
 static inline bool _is_permitted(const fs::path &path, int acc, bool trace_on_prohibition) {
     ++acc;
-    if (_is_permitted_cache[acc].count(path))
+    if (path_mask(path) >> acc & 1)
         return true;
-    int permitted = 0;
-    for (auto p = fs::canonical(path.parent_path()) / path.filename();;) {
-        auto id = get_identity(p.parent_path());
-        if (auto it = files_permission.find({id, p.filename()}); it != files_permission.end()) {
-            if ((acc & it->second) == acc) { // 越权访问
-                _is_permitted_cache[acc].insert(path);
-                return true;
-            }
-            permitted |= it->second;
-        }
-        auto nxt = p.parent_path();
-        if (p == nxt)
-            break;
-        p = nxt;
-    }
     // 无权限
     cerr << "not permitted: " << path << endl;
     if (trace_on_prohibition) { // 显示详细调试信息
-        auto p = fs::canonical(path.parent_path()) / path.filename();
+        std::error_code ec;
+        auto p = fs::weakly_canonical(path.parent_path(), ec) / path.filename();
+        int permitted = 0;
+        for (auto q = p;;) {
+            if (auto it = files_permission.find({get_identity(q.parent_path()), q.filename()}); it != files_permission.end())
+                permitted |= it->second;
+            auto nxt = q.parent_path();
+            if (q == nxt)
+                break;
+            q = nxt;
+        }
         trace_file_operation.active = 1;
         trace_file_operation.p = p;
         trace_file_operation.ori = path;
@@ -161,33 +198,35 @@ static inline bool _is_permitted(const fs::path &path, int acc, bool trace_on_pr
     }
     return false;
 }
-const std::regex pattern_pipe("(^pipe:\\[\\d+\\]$)");
+// 匿名管道的链接目标，格式为 pipe:[123456]
+static inline bool is_pipe_name(const std::string &name) {
+    if (name.size() < 8 || name.compare(0, 6, "pipe:[") != 0 || name.back() != ']')
+        return false;
+    for (size_t i = 6; i + 1 < name.size(); ++i)
+        if (name[i] < '0' || name[i] > '9')
+            return false;
+    return true;
+}
 static inline bool is_permitted(const fs::path &path, int acc, bool trace_on_prohibition) {
-    if (fs::is_symlink(path))
-        return _is_permitted(path, acc, trace_on_prohibition);
     // cerr << "check " << acc << " on " << path << endl;
-    fs::file_status status = fs::status(path);
-    if (fs::is_fifo(status)) { // 命名管道
-        trace_file_operation.msg = "fifo";
-    } else if (fs::is_socket(status)) { // 套接字
-        trace_file_operation.msg = "socket";
-    } else if (fs::is_block_file(status)) { // 块设备
-        return _is_permitted(path, acc, trace_on_prohibition);
-    } else if (fs::is_character_file(status)) { // 字符设备
-        return _is_permitted(path, acc, trace_on_prohibition);
-    } else if (fs::is_regular_file(status)) { // 普通文件
+    struct stat64 st;
+    if (lstat64(path.c_str(), &st) == -1)
         return _is_permitted(path, acc, trace_on_prohibition);
-    } else if (fs::is_directory(status)) { // 目录
+    switch (st.st_mode & S_IFMT) {
+    case S_IFLNK: // 符号链接
         return _is_permitted(path, acc, trace_on_prohibition);
-    } else if (!fs::exists(path)) {
-        if (std::regex_match(path.filename().string(), pattern_pipe)) {
-            // 匿名管道，格式为 pipe:[123456]
-            // 由于没有批准子进程创建管道，一般由父进程传递，可以批准
-            // 这样可能造成错误判断，要求文件名不含冒号
-            return true;
-        }
+    case S_IFBLK: // 块设备
+    case S_IFCHR: // 字符设备
+    case S_IFREG: // 普通文件
+    case S_IFDIR: // 目录
         return _is_permitted(path, acc, trace_on_prohibition);
-    } else {
+    case S_IFIFO: // 命名管道
+        trace_file_operation.msg = "fifo";
+        break;
+    case S_IFSOCK: // 套接字
+        trace_file_operation.msg = "socket";
+        break;
+    default:
         trace_file_operation.msg = "other";
     }
     if (trace_on_prohibition) {
@@ -201,7 +240,18 @@ static inline bool is_permitted(const fs::path &path, int acc, bool trace_on_pro
 }
 static inline bool check_fd_operation(int fd, int acc, bool trace_on_prohibition = true) {
     try {
-        return is_permitted(fs::absolute(fs::read_symlink(child_dirfd_path / std::to_string(fd))), acc, trace_on_prohibition);
+        auto target = fs::read_symlink(child_dirfd_path / std::to_string(fd));
+        // 只有文件描述符的链接目标可能是匿名管道或 memfd，按路径访问的文件不适用，否则选手程序可以创建这样命名的文件
+        if (is_pipe_name(target.native())) {
+            // 由于没有批准子进程创建管道，一般由父进程传递，可以批准
+            return true;
+        }
+        if (target.native().compare(0, 7, "/memfd:") == 0) {
+            // memfd，格式为 /memfd:name (deleted)
+            // 没有批准子进程创建 memfd，只能是父进程传递的标准输入输出
+            return true;
+        }
+        return is_permitted(fs::absolute(target), acc, trace_on_prohibition);
     } catch (const fs::filesystem_error &e) {
         cerr << e.what() << endl;
         return false;
@@ -230,51 +280,6 @@ static inline bool check_ioctl(int fd, unsigned long request) {
     return _IOC_DIR(request) == _IOC_NONE || _IOC_DIR(request) == _IOC_READ;
 }
 
-#define BPF_ALLOW(x)                                \
-    BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, (x), 0, 1), \
-        BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_ALLOW)
-static inline int install_filter_raw() {
-    struct sock_filter filter[] = {
-        BPF_STMT(BPF_LD | BPF_W | BPF_ABS, offsetof(struct seccomp_data, nr)),
-        // 常用操作
-        BPF_ALLOW(SYS_read),
-        BPF_ALLOW(SYS_write),
-        BPF_ALLOW(SYS_close),
-        BPF_ALLOW(SYS_lseek),
-        // 内存
-        BPF_ALLOW(SYS_brk),
-        BPF_ALLOW(SYS_mmap),
-        BPF_ALLOW(SYS_munmap),
-        BPF_ALLOW(SYS_mprotect),
-        BPF_ALLOW(SYS_msync),
-        BPF_ALLOW(SYS_madvise),
-        // 文件系统操作
-        BPF_ALLOW(SYS_access),
-        BPF_ALLOW(SYS_faccessat),
-        BPF_ALLOW(SYS_stat),
-        BPF_ALLOW(SYS_lstat),
-        BPF_ALLOW(SYS_fstat),
-        // 系统运行需要
-        BPF_ALLOW(SYS_getpid),
-        BPF_ALLOW(SYS_gettid),
-        BPF_ALLOW(SYS_getcwd),
-        BPF_ALLOW(SYS_tgkill),
-        BPF_ALLOW(SYS_arch_prctl),
-        BPF_ALLOW(SYS_sendmsg),
-        BPF_ALLOW(SYS_exit),
-        BPF_ALLOW(SYS_exit_group),
-        // 默认
-        BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_USER_NOTIF),
-        // BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_LOG),
-    };
-    struct sock_fprog prog = {
-        .len = sizeof(filter) / sizeof(filter[0]),
-        .filter = filter,
-    };
-    // cerr << "BPF: " << prog.len << " instructions" << endl;
-    prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0);
-    return (int)syscall(__NR_seccomp, SECCOMP_SET_MODE_FILTER, SECCOMP_FILTER_FLAG_NEW_LISTENER, &prog);
-}
 static inline int install_signalfd() {
     sigset_t mask;
     sigemptyset(&mask);
@@ -333,63 +338,142 @@ static inline int recv_fd(int socket) {
 }
 
 bool child_execved;
-static inline bool handle_syscall(int syscall, unsigned long long args[]) {
-    switch (syscall) {
-    case SYS_open:
-        return check_file_operation(args[1], args[2] & O_ACCMODE);
-    case SYS_openat:
-        return check_file_operation_at((int)args[0], args[1], args[2] & O_ACCMODE);
-    case SYS_ioctl:
-        return check_ioctl((int)args[0], args[1]);
-    case SYS_statx:
-    case SYS_newfstatat:
-        return check_file_operation_at((int)args[0], args[1], args[2] & O_ACCMODE);
-    case SYS_dup:
-    case SYS_dup2:
-    case SYS_dup3:
-        return check_fd_operation((int)args[0], -1);
-    case SYS_statfs:
-        return check_file_operation((int)args[0], -1);
-    case SYS_fstatfs:
-        return check_fd_operation((int)args[0], -1);
-    // 文件操作
-    case SYS_pread64:
-    case SYS_pwrite64:
-    case SYS_readv:
-    case SYS_writev:
-    case SYS_preadv:
-    case SYS_pwritev:
-    case SYS_preadv2:
-    case SYS_pwritev2:
+int64_t notifications; // seccomp 提醒次数
+
+// 系统调用策略表，同时生成 seccomp-bpf 程序和用户空间检查（handle_syscall）
+// check 为空的系统调用在内核中直接放行，不产生提醒
+// 有参数规则时，args[arg] 的低 32 位与 mask 按位与后等于 value 则在内核中放行，否则交给 check
+// 不在表中的系统调用交给用户空间后拒绝
+// 只有选手程序使用此表，受信任的程序（校验器、交互库等）由 sandbox-tiny 运行，不限制系统调用
+struct rule_t {
+    long nr;
+    bool (*check)(const unsigned long long args[]);
+    int arg;
+    uint32_t mask, value;
+};
+#define ALLOW(x) {(x), nullptr, -1, 0, 0}
+#define CHECK(x, expr) {(x), []([[maybe_unused]] const unsigned long long args[]) -> bool { return (expr); }, -1, 0, 0}
+#define CHECK_ARG(x, expr, arg, mask, value) {(x), []([[maybe_unused]] const unsigned long long args[]) -> bool { return (expr); }, (arg), (mask), (value)}
+const rule_t policy[] = {
+    // 常用操作
+    ALLOW(SYS_read),
+    ALLOW(SYS_write),
+    ALLOW(SYS_close),
+    ALLOW(SYS_lseek),
+    ALLOW(SYS_pread64),
+    ALLOW(SYS_pwrite64),
+    ALLOW(SYS_readv),
+    ALLOW(SYS_writev),
+    ALLOW(SYS_preadv),
+    ALLOW(SYS_pwritev),
+    ALLOW(SYS_preadv2),
+    ALLOW(SYS_pwritev2),
+    // 内存
+    ALLOW(SYS_brk),
+    ALLOW(SYS_mmap),
+    ALLOW(SYS_munmap),
+    ALLOW(SYS_mprotect),
+    ALLOW(SYS_msync),
+    ALLOW(SYS_madvise),
+    // 文件系统操作
+    ALLOW(SYS_access),
+    ALLOW(SYS_faccessat),
+    ALLOW(SYS_stat),
+    ALLOW(SYS_lstat),
+    ALLOW(SYS_fstat),
+    CHECK(SYS_open, check_file_operation((long)args[1], args[2] & O_ACCMODE)),
+    CHECK(SYS_openat, check_file_operation_at((int)args[0], (long)args[1], args[2] & O_ACCMODE)),
+    CHECK(SYS_statx, check_file_operation_at((int)args[0], (long)args[1], args[2] & O_ACCMODE)),
+    CHECK(SYS_newfstatat, check_file_operation_at((int)args[0], (long)args[1], args[2] & O_ACCMODE)),
+    CHECK(SYS_statfs, check_file_operation((long)args[0], -1)),
+    CHECK(SYS_fstatfs, check_fd_operation((int)args[0], -1)),
+    CHECK(SYS_dup, check_fd_operation((int)args[0], -1)),
+    CHECK(SYS_dup2, check_fd_operation((int)args[0], -1)),
+    CHECK(SYS_dup3, check_fd_operation((int)args[0], -1)),
+    // 不写入设备的 ioctl（_IOC_NONE 和 _IOC_READ）在内核中放行
+    CHECK_ARG(SYS_ioctl, check_ioctl((int)args[0], args[1]), 1, _IOC_WRITE << _IOC_DIRSHIFT, 0),
     // 信号
-    case SYS_rt_sigaction: // 开放这些调用可能导致 SIGALRM 被覆盖，只能被主进程/ulimit 杀死
-    case SYS_rt_sigprocmask:
-    case SYS_rt_sigreturn:
-    case SYS_setitimer:
-    case SYS_getitimer:
-    case SYS_timer_create:
-    case SYS_timer_delete:
+    ALLOW(SYS_rt_sigaction), // 开放这些调用可能导致 SIGALRM 被覆盖，只能被主进程/ulimit 杀死
+    ALLOW(SYS_rt_sigprocmask),
+    ALLOW(SYS_rt_sigreturn),
+    ALLOW(SYS_setitimer),
+    ALLOW(SYS_getitimer),
+    ALLOW(SYS_timer_create),
+    ALLOW(SYS_timer_delete),
     // 时间
-    case SYS_gettimeofday:
-    case SYS_clock_gettime: // 获取时钟时间
-    case SYS_time:          // 获取秒级时间
-    case SYS_times:         // 获取进程时间
+    ALLOW(SYS_gettimeofday),
+    ALLOW(SYS_clock_gettime), // 获取时钟时间
+    ALLOW(SYS_time),          // 获取秒级时间
+    ALLOW(SYS_times),         // 获取进程时间
     // 随机
-    case SYS_getrandom:
-    // 其他
-    case SYS_sched_yield: // 让出CPU
-        return true;
-    case SYS_execve: {
-        if (child_execved)
-            return false;
-        child_execved = true;
-        return true;
-    }
-    default: {
-        cerr << "\033[31;1mdeny\033[0m " << syscall << endl;
-        return false;
-    }
+    ALLOW(SYS_getrandom),
+    // 系统运行需要
+    ALLOW(SYS_getpid),
+    ALLOW(SYS_gettid),
+    ALLOW(SYS_getcwd),
+    ALLOW(SYS_tgkill),
+    ALLOW(SYS_arch_prctl),
+    ALLOW(SYS_sendmsg),
+    ALLOW(SYS_sched_yield), // 让出CPU
+    ALLOW(SYS_exit),
+    ALLOW(SYS_exit_group),
+    // 只允许沙箱自身的一次 execve
+    CHECK(SYS_execve, !child_execved && (child_execved = true)),
+};
+#undef ALLOW
+#undef CHECK
+#undef CHECK_ARG
+static inline bool handle_syscall(int syscall, unsigned long long args[]) {
+    static const auto rules = [] {
+        std::unordered_map<long, const rule_t *> res;
+        for (const auto &rule : policy)
+            res[rule.nr] = &rule;
+        return res;
+    }();
+    if (auto it = rules.find(syscall); it != rules.end())
+        return it->second->check == nullptr || it->second->check(args);
+    cerr << "\033[31;1mdeny\033[0m " << syscall << endl;
+    return false;
+}
+static inline int install_filter_raw() {
+    std::vector<struct sock_filter> filter;
+    // 系统调用号只在 x86_64 架构下有意义，例如 int 0x80 发起的 i386 系统调用 5 是 open 而不是 fstat，直接杀死
+    filter.push_back(BPF_STMT(BPF_LD | BPF_W | BPF_ABS, offsetof(struct seccomp_data, arch)));
+    filter.push_back(BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, AUDIT_ARCH_X86_64, 1, 0));
+    filter.push_back(BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_KILL_PROCESS));
+    filter.push_back(BPF_STMT(BPF_LD | BPF_W | BPF_ABS, offsetof(struct seccomp_data, nr)));
+    // x32 系统调用与 x86_64 同架构但系统调用号带有 __X32_SYSCALL_BIT，交给默认处理
+    filter.push_back(BPF_JUMP(BPF_JMP | BPF_JSET | BPF_K, __X32_SYSCALL_BIT, 0, 1));
+    filter.push_back(BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_USER_NOTIF));
+    for (const auto &rule : policy) {
+        if (rule.check == nullptr) {
+            filter.push_back(BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, (uint32_t)rule.nr, 0, 1));
+            filter.push_back(BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_ALLOW));
+        } else if (rule.arg != -1) {
+            // 只比较参数的低 32 位（小端序）
+            filter.push_back(BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, (uint32_t)rule.nr, 0, 5));
+            filter.push_back(BPF_STMT(BPF_LD | BPF_W | BPF_ABS, (uint32_t)(offsetof(struct seccomp_data, args) + sizeof(uint64_t) * (size_t)rule.arg)));
+            filter.push_back(BPF_STMT(BPF_ALU | BPF_AND | BPF_K, rule.mask));
+            filter.push_back(BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, rule.value, 0, 1));
+            filter.push_back(BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_ALLOW));
+            filter.push_back(BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_USER_NOTIF));
+        }
     }
+    // 默认
+    filter.push_back(BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_USER_NOTIF));
+    // filter.push_back(BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_LOG));
+    struct sock_fprog prog = {
+        .len = (unsigned short)filter.size(),
+        .filter = filter.data(),
+    };
+    // cerr << "BPF: " << prog.len << " instructions" << endl;
+    prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0);
+    return (int)syscall(__NR_seccomp, SECCOMP_SET_MODE_FILTER, SECCOMP_FILTER_FLAG_NEW_LISTENER, &prog);
+}
+static inline bool child_exited() {
+    siginfo_t info;
+    info.si_pid = 0;
+    return waitid(P_PID, (id_t)child_pid, &info, WEXITED | WNOHANG | WNOWAIT) == 0 && info.si_pid == child_pid;
 }
 static inline int tracer(int listener_fd, int signal_fd) {
     struct seccomp_notif *notif;
@@ -399,6 +483,12 @@ static inline int tracer(int listener_fd, int signal_fd) {
     notif = (struct seccomp_notif *)malloc(sizes.seccomp_notif);
     resp = (struct seccomp_notif_resp *)malloc(sizes.seccomp_notif_resp);
     kill(child_pid, SIGCONT);
+    // 子进程可能在安装 signalfd 之前就已经被杀死（例如挂起时收到 SIGALRM），此时 SIGCHLD 不会再出现
+    if (child_exited()) {
+        free(notif);
+        free(resp);
+        return 0;
+    }
     struct pollfd pfds[2]{
         {.fd = listener_fd, .events = POLLIN | POLLPRI, .revents = 0},
         {.fd = signal_fd, .events = POLLIN | POLLPRI, .revents = 0}};
@@ -413,17 +503,16 @@ static inline int tracer(int listener_fd, int signal_fd) {
             break;
         }
         if (pfds[1].revents & (POLLIN | POLL_PRI)) {
+            // SIGCHLD 可能合并（例如挂起、恢复和退出），因此读空 signalfd 后直接检查子进程是否退出
             struct signalfd_siginfo siginfo;
-            ssize_t s = read(signal_fd, &siginfo, sizeof(siginfo));
-            if (s == sizeof(siginfo)) {
-                if (siginfo.ssi_signo == SIGCHLD) {
-                    if (siginfo.ssi_code == CLD_EXITED || siginfo.ssi_code == CLD_KILLED || siginfo.ssi_code == CLD_DUMPED)
-                        break;
-                } else
+            while (read(signal_fd, &siginfo, sizeof(siginfo)) == sizeof(siginfo))
+                if (siginfo.ssi_signo != SIGCHLD)
                     cerr << "Received signal " << siginfo.ssi_signo << endl;
-            } else
-                cerr << "Failed to read from signalfd" << endl;
+            if (child_exited())
+                break;
         }
+        if (pfds[0].revents & (POLLHUP | POLLERR | POLLNVAL)) // 子进程已经退出，不会再有提醒
+            break;
         if (pfds[0].revents & (POLLIN | POLL_PRI)) {
             memset(notif, 0, sizes.seccomp_notif);
             memset(resp, 0, sizes.seccomp_notif_resp);
@@ -435,6 +524,7 @@ static inline int tracer(int listener_fd, int signal_fd) {
                 break;
             }
             resp->id = notif->id;
+            ++notifications;
             if (handle_syscall(notif->data.nr, notif->data.args)) {
                 resp->flags = SECCOMP_USER_NOTIF_FLAG_CONTINUE;
                 resp->val = 0;
@@ -461,21 +551,48 @@ static inline int tracer(int listener_fd, int signal_fd) {
     return ret;
 }
 
-time_t start_time;
+time_t start_time, run_time, wall_time;
 int status;
 rusage usage;
 bool child_overdue;
+int signal_fd = -1;
+int result_fd = -1; // 向 sandbox.py 发送结果记录的文件描述符，子进程不应继承
 
-int main(int argc, char *argv[]) {
-    char *prog_path = argv[1];
-    char *output = argv[2];
-    time_limit = atol(argv[3]);
-    mem_limit = atol(argv[4]);
-    stack_limit = atol(argv[5]);
-    fsize_limit = atol(argv[6]);
-    // argv[7] 是 cpuset 的二进制掩码
-    int file_cnt = atoi(argv[8]);
-    int args_st = 9 + (file_cnt << 1);
+static inline time_t monotonic() {
+    timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec * 1000000 + t.tv_nsec / 1000;
+}
+
+static inline void add_default_permissions() {
+    add_permission("/etc/ld.so.preload", 0);
+    add_permission("/etc/ld.so.cache", 0);
+    add_permission("/lib", 0);
+    add_permission("/usr/lib", 0);
+    add_permission("/dev/random", 0);
+    add_permission("/dev/urandom", 0);
+    add_permission("/dev/null", 0);
+    add_permission("/etc/localtime", 0);
+    if (char *p = ttyname(stdin->_fileno); p != nullptr)
+        add_permission(p, 0);
+    if (char *p = ttyname(stdout->_fileno); p != nullptr)
+        add_permission(p, 1);
+    if (char *p = ttyname(stderr->_fileno); p != nullptr)
+        add_permission(p, 1);
+}
+static inline void redirect(const char *path, int fd, int flags) {
+    // 空路径表示 /dev/null
+    int x = open(*path ? path : "/dev/null", flags, 0644);
+    if (x == -1) {
+        perror("open failed");
+        _exit(128);
+    }
+    dup2(x, fd);
+    close(x);
+}
+// 运行一次程序，返回运行状态，-1 表示沙箱出错
+// in_path 为空指针时沿用沙箱的标准输入输出，并在子进程准备好后挂起沙箱等待进一步指令；否则是批处理模式，不挂起
+static inline int run_job(char *prog_path, char **args, const char *cpuset, const char *in_path, const char *out_path) {
     itimerval it;
     it.it_value.tv_sec = time_limit / 1000000;
     it.it_value.tv_usec = time_limit % 1000000;
@@ -483,17 +600,25 @@ int main(int argc, char *argv[]) {
     struct sigaction sa;
     sigemptyset(&sa.sa_mask);
     sa.sa_flags = 0;
+    child_execved = false;
+    child_overdue = false;
+    notifications = 0;
     int socket_pair[2];
     socketpair(AF_UNIX, SOCK_STREAM, 0, socket_pair);
     pid = fork();
     if (pid == 0) {
         pid = getpid();
         close(socket_pair[0]);
-        char **args = new char *[argc - args_st + 2];
-        args[0] = prog_path;
-        for (int i = args_st; i < argc; ++i)
-            args[i - args_st + 1] = argv[i];
-        args[argc - args_st + 1] = nullptr;
+        if (result_fd != STDOUT_FILENO)
+            close(result_fd);
+        if (in_path != nullptr) {
+            redirect(in_path, STDIN_FILENO, O_RDONLY);
+            redirect(out_path, STDOUT_FILENO, O_WRONLY | O_CREAT | O_TRUNC);
+            close(signal_fd);
+            sigset_t mask;
+            sigemptyset(&mask);
+            sigprocmask(SIG_SETMASK, &mask, nullptr);
+        }
         sa.sa_handler = [](int sig) {
             if (sig == SIGALRM && pid > 0)
                 tgkill(pid, gettid(), SIGKILL);
@@ -501,8 +626,8 @@ int main(int argc, char *argv[]) {
         sigaction(SIGALRM, &sa, nullptr);
         cpu_set_t mask;
         CPU_ZERO(&mask);
-        for (int i = 0; argv[7][i]; ++i)
-            if (argv[7][i] == '1')
+        for (int i = 0; cpuset[i]; ++i)
+            if (cpuset[i] == '1')
                 CPU_SET(i, &mask);
         sched_setaffinity(pid, sizeof(mask), &mask);
         apply_rlimit();
@@ -512,92 +637,196 @@ int main(int argc, char *argv[]) {
         setitimer(ITIMER_PROF, &it, nullptr);
         execv(prog_path, args);
         perror("execv failed");
-        delete[] args;
-        return 128;
-    } else if (pid > 0) {
-        child_pid = pid;
-        pid = getpid();
+        _exit(128);
+    } else if (pid < 0) {
+        perror("fork failed");
+        close(socket_pair[0]);
         close(socket_pair[1]);
-        add_permission("/etc/ld.so.preload", 0);
-        add_permission("/etc/ld.so.cache", 0);
-        add_permission("/lib", 0);
-        add_permission("/usr/lib", 0);
-        add_permission("/dev/random", 0);
-        add_permission("/dev/urandom", 0);
-        add_permission("/dev/null", 0);
-        add_permission("/etc/localtime", 0);
-        if (char *p = ttyname(stdin->_fileno); p != nullptr)
-            add_permission(p, 0);
-        if (char *p = ttyname(stdout->_fileno); p != nullptr)
-            add_permission(p, 1);
-        if (char *p = ttyname(stderr->_fileno); p != nullptr)
-            add_permission(p, 1);
-        for (int i = 0; i < file_cnt; ++i)
-            add_permission(fs::path(argv[9 + (i << 1)]).lexically_normal(), atoi(argv[9 + (i << 1 | 1)]));
-        it.it_value.tv_sec += 1;
-        sa.sa_handler = [](int sig) {
-            if (sig == SIGALRM && child_pid > 0) {
-                kill(child_pid, SIGKILL);
-                child_overdue = true;
-            }
-        };
-        sigaction(SIGALRM, &sa, nullptr);
-        child_dirfd_path = fs::path("/proc/" + std::to_string(child_pid) + "/fd/");
-        wait4(child_pid, &status, WUNTRACED, &usage);
-        start_time = trans(usage);
+        return -1;
+    }
+    child_pid = pid;
+    pid = getpid();
+    close(socket_pair[1]);
+    it.it_value.tv_sec += 1;
+    sa.sa_handler = [](int sig) {
+        if (sig == SIGALRM && child_pid > 0) {
+            kill(child_pid, SIGKILL);
+            child_overdue = true;
+        }
+    };
+    sigaction(SIGALRM, &sa, nullptr);
+    child_dirfd_path = fs::path("/proc/" + std::to_string(child_pid) + "/fd/");
+    wait4(child_pid, &status, WUNTRACED, &usage);
+    start_time = trans(usage);
+    if (in_path == nullptr) {
+        write_ready(result_fd);
         kill(pid, SIGSTOP); // 挂起等待进一步指令
-        int signal_fd = install_signalfd();
-        int listener_fd = recv_fd(socket_pair[0]);
-        close(socket_pair[0]);
-        setitimer(ITIMER_REAL, &it, nullptr);
-        int ret = tracer(listener_fd, signal_fd);
-        if (ret == -1)
-            return 1;
-        if (wait4(child_pid, &status, WUNTRACED, &usage) == child_pid) {
-            if (!ret) {
-                if (WIFEXITED(status))
-                    ret = EXIT | WEXITSTATUS(status);
-                else if (WIFSIGNALED(status)) {
-                    int sig = WTERMSIG(status);
-                    if (sig == SIGXCPU)
-                        ret = TLE;
-                    else if (sig == SIGXFSZ)
-                        ret = OLE;
-                    else
-                        ret = SIG | WTERMSIG(status);
-                } else
-                    ret = -1;
+    }
+    if (signal_fd == -1)
+        signal_fd = install_signalfd();
+    int listener_fd = recv_fd(socket_pair[0]);
+    close(socket_pair[0]);
+    setitimer(ITIMER_REAL, &it, nullptr);
+    time_t wall_start = monotonic();
+    int ret = tracer(listener_fd, signal_fd);
+    if (ret == -1)
+        kill(child_pid, SIGKILL);
+    if (wait4(child_pid, &status, WUNTRACED, &usage) == child_pid) {
+        wall_time = monotonic() - wall_start;
+        if (!ret) {
+            if (WIFEXITED(status))
+                ret = EXIT | WEXITSTATUS(status);
+            else if (WIFSIGNALED(status)) {
+                int sig = WTERMSIG(status);
+                if (sig == SIGXCPU)
+                    ret = TLE;
+                else if (sig == SIGXFSZ)
+                    ret = OLE;
+                else
+                    ret = SIG | WTERMSIG(status);
+            } else
+                ret = -1;
+        }
+    } else {
+        perror("waitpid failed");
+        ret = -1;
+    }
+    it.it_value.tv_sec = it.it_value.tv_usec = 0;
+    setitimer(ITIMER_REAL, &it, nullptr);
+    child_pid = 0;
+    close(listener_fd);
+    if (ret == -1)
+        return -1;
+    run_time = trans(usage) - start_time;
+    if (child_overdue)
+        ret = TLE | TLE_OVERDUE;
+    else if (run_time > time_limit)
+        ret = TLE;
+    return ret;
+}
+static inline bool write_result(int fd, int ret) {
+    result_t res;
+    memset(&res, 0, sizeof(res));
+    res.status = ret;
+    if (ret == -1)
+        return write_record(fd, res, nullptr, 0);
+    res.time = run_time;
+    res.memory = usage.ru_maxrss << 10;
+    res.wall_time = wall_time;
+    res.nvcsw = usage.ru_nvcsw;
+    res.nivcsw = usage.ru_nivcsw;
+    res.minflt = usage.ru_minflt;
+    res.majflt = usage.ru_majflt;
+    res.notifications = notifications;
+    std::ostringstream out;
+    if (trace_file_operation.active == 1) {
+        out << "not permitted(acc=" << trace_file_operation.acc << "  permitted=" << trace_file_operation.permitted << "): " << trace_file_operation.ori;
+        if (trace_file_operation.ori != trace_file_operation.p)
+            out << " (aka " << trace_file_operation.ori << ")";
+    } else if (trace_file_operation.active == 2) {
+        out << "not permitted(acc=" << trace_file_operation.acc << "): " << trace_file_operation.ori << '\n';
+        out << trace_file_operation.msg;
+    }
+    std::string msg = out.str();
+    return write_record(fd, res, msg.data(), msg.size());
+}
+
+// 批处理模式：sandbox --batch <prog> [args...]
+// 默认权限只注册一次，然后从标准输入逐个读取任务，每行一项：
+//   工作目录 输入文件 输出文件 时间限制 空间限制 栈空间限制 文件大小限制 cpuset 掩码 文件数 (文件 权限)...
+// 每个任务完成后向标准输出写入一条结果记录，格式与单次运行相同，沙箱出错时运行状态为 -1。
+static inline int batch(char *argv[]) {
+    char *prog_path = argv[2];
+    char **args = argv + 2;
+    add_default_permissions();
+    auto base = files_permission;
+    signal_fd = install_signalfd();
+    result_fd = STDOUT_FILENO;
+    std::string cwd, in_path, out_path, cpuset, s, file;
+    // 任务之间没有子进程需要杀死，忽略 SIGALRM（沙箱组可能随时终止任务），否则会终止沙箱或中断任务的读取
+    signal(SIGALRM, SIG_IGN);
+    while (std::getline(std::cin, cwd) && std::getline(std::cin, in_path) && std::getline(std::cin, out_path)) {
+        try {
+            std::getline(std::cin, s), time_limit = std::stol(s);
+            std::getline(std::cin, s), mem_limit = std::stol(s);
+            std::getline(std::cin, s), stack_limit = std::stol(s);
+            std::getline(std::cin, s), fsize_limit = std::stol(s);
+            std::getline(std::cin, cpuset);
+            std::getline(std::cin, s);
+            for (int i = std::stoi(s); i > 0; --i) {
+                std::getline(std::cin, file);
+                std::getline(std::cin, s);
+                add_permission(fs::path(file).lexically_normal(), std::stoi(s));
             }
-        } else {
-            perror("waitpid failed");
-            ret = -1;
+        } catch (const std::exception &e) {
+            cerr << "invalid job: " << e.what() << endl;
+            return 1;
         }
-        time_t t = trans(usage) - start_time;
-        if (child_overdue)
-            ret = TLE | TLE_OVERDUE;
-        else if (t > time_limit)
-            ret = TLE;
-        close(signal_fd);
-        close(listener_fd);
-        if (ret == -1)
+        // 切换到任务的工作目录，子进程会继承，检查权限时解析相对路径也依赖于此
+        int ret = chdir(cwd.c_str()) == 0 ? run_job(prog_path, args, cpuset.c_str(), in_path.c_str(), out_path.c_str()) : -1;
+        if (!write_result(result_fd, ret))
             return 1;
-        std::ofstream out(output, std::ios::out);
-        out << t << '\n';
-        out << (usage.ru_maxrss << 10) << '\n';
-        out << ret << '\n';
-#ifndef TINY
-        if (trace_file_operation.active == 1) {
-            out << "not permitted(acc=" << trace_file_operation.acc << "  permitted=" << trace_file_operation.permitted << "): " << trace_file_operation.ori;
-            if (trace_file_operation.ori != trace_file_operation.p)
-                out << " (aka " << trace_file_operation.ori << ")";
-            out << '\n';
-        } else if (trace_file_operation.active == 2) {
-            out << "not permitted(acc=" << trace_file_operation.acc << "): " << trace_file_operation.ori << '\n';
-            out << trace_file_operation.msg << '\n';
+        files_permission = base;
+        clear_verdicts();
+        trace_file_operation.active = 0;
+        signal(SIGALRM, SIG_IGN);
+    }
+    return 0;
+}
+
+// 基准测试：sandbox --bench [路径...]
+// 按评测时的方式注册权限，反复检查给定路径的读权限（默认是程序启动时动态链接器等访问的路径），输出每次检查的平均耗时。
+// 路径通过 read_string 从自身内存读取，与处理系统调用提醒时相同。冷启动每轮先清空判定缓存，与批处理模式中的新任务相同。
+static inline int bench(int argc, char *argv[]) {
+    add_default_permissions();
+    add_permission(fs::absolute("1.in"), 0);
+    std::vector<std::string> paths(argv + 2, argv + argc);
+    if (paths.empty())
+        paths = {"/etc/ld.so.cache", "/lib/x86_64-linux-gnu/libc.so.6", "/lib/x86_64-linux-gnu/libm.so.6",
+                 "/usr/lib/x86_64-linux-gnu/libstdc++.so.6", "/usr/lib/x86_64-linux-gnu/libgcc_s.so.1",
+                 "/etc/localtime", "/dev/urandom", "1.in"};
+    child_pid = getpid();
+    const int rounds = 10000;
+    for (int cold = 1; cold >= 0; --cold) {
+        time_t start = monotonic();
+        for (int i = 0; i < rounds; ++i) {
+            if (cold)
+                clear_verdicts();
+            for (const auto &p : paths)
+                check_file_operation((long)p.c_str(), 0, false);
         }
-#endif
-        out.close();
-        return 0;
+        std::cout << (cold ? "cold: " : "warm: ") << (monotonic() - start) * 1000 / rounds / (time_t)paths.size() << " ns/check" << endl;
     }
-    return 128;
-}
\ No newline at end of file
+    return 0;
+}
+
+int main(int argc, char *argv[]) {
+    if (argc > 2 && strcmp(argv[1], "--batch") == 0)
+        return batch(argv);
+    if (argc > 1 && strcmp(argv[1], "--bench") == 0)
+        return bench(argc, argv);
+    char *prog_path = argv[1];
+    result_fd = atoi(argv[2]); // argv[2] 是结果记录的文件描述符
+    time_limit = atol(argv[3]);
+    mem_limit = atol(argv[4]);
+    stack_limit = atol(argv[5]);
+    fsize_limit = atol(argv[6]);
+    // argv[7] 是 cpuset 的二进制掩码
+    int file_cnt = atoi(argv[8]);
+    int args_st = 9 + (file_cnt << 1);
+    char **args = new char *[argc - args_st + 2];
+    args[0] = prog_path;
+    for (int i = args_st; i < argc; ++i)
+        args[i - args_st + 1] = argv[i];
+    args[argc - args_st + 1] = nullptr;
+    add_default_permissions();
+    for (int i = 0; i < file_cnt; ++i)
+        add_permission(fs::path(argv[9 + (i << 1)]).lexically_normal(), atoi(argv[9 + (i << 1 | 1)]));
+    int ret = run_job(prog_path, args, argv[7], nullptr, nullptr);
+    delete[] args;
+    close(signal_fd);
+    if (ret == -1 || !write_result(result_fd, ret))
+        return 1;
+    close(result_fd);
+    return 0;
+}
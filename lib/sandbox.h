@@ -7,3 +7,50 @@
 #define FBD 0x200000
 
 #define TLE_OVERDUE 1
+
+#include <errno.h>
+#include <stdint.h>
+#include <string.h>
+#include <unistd.h>
+
+// 结果记录，沙箱通过继承的文件描述符发送给 sandbox.py，长度为 msg_len 的附加信息紧随其后
+// 修改时需要同步修改 sandbox.py 中的 RESULT
+struct result_t {
+    int64_t time;          // CPU 时间
+    int64_t memory;        // 最大常驻内存
+    int64_t wall_time;     // 墙上时间
+    int64_t nvcsw, nivcsw; // 主动和被动上下文切换次数
+    int64_t minflt, majflt; // 次要和主要缺页次数
+    int64_t notifications; // seccomp 提醒次数
+    int32_t status;        // 运行状态，-1 表示沙箱出错
+    uint32_t msg_len;
+};
+static_assert(sizeof(result_t) == 72, "result_t must not be padded");
+
+#define MSG_MAX 4096
+
+static inline bool write_all(int fd, const void *buf, size_t len) {
+    const char *p = (const char *)buf;
+    while (len) {
+        ssize_t x = write(fd, p, len);
+        if (x < 0) {
+            if (errno == EINTR)
+                continue;
+            return false;
+        }
+        p += x;
+        len -= (size_t)x;
+    }
+    return true;
+}
+// 非批处理模式下沙箱准备好后先发送一个字节再挂起，sandbox.py 可以在事件循环中监听该文件描述符而不必轮询挂起状态
+static inline bool write_ready(int fd) {
+    char c = 0;
+    return write_all(fd, &c, 1);
+}
+static inline bool write_record(int fd, result_t &res, const char *msg, size_t len) {
+    if (len > MSG_MAX)
+        len = MSG_MAX;
+    res.msg_len = (uint32_t)len;
+    return write_all(fd, &res, sizeof(res)) && write_all(fd, msg, len);
+}
@@ -1,15 +1,19 @@
+import asyncio
 import ctypes
+import functools
 import os
 import shutil
 import signal
+import struct
 import subprocess
 import sys
 import threading
+from contextlib import contextmanager
 
 from . import userconf
-from .core import DEBUG_SANDBOX, acquire_cpu, release_cpu, error, warning
+from .core import DEBUG_SANDBOX, acquire_cpu, release_cpu, take_bound_cpu, give_bound_cpu, error, warning
 from .ds import Program, Limit, Verdict
-from .utils import fmemory, hash32, random_hash, stdopen
+from .utils import fmemory, stdopen
 
 SANDBOX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox")
 SANDBOX_TINY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox-tiny")
@@ -24,6 +28,10 @@ FBD = 0x200000
 
 TLE_OVERDUE = 1
 
+# sandbox.h 中定义的结果记录 result_t：CPU 时间、内存、墙上时间、主动和被动上下文切换、次要和主要缺页、seccomp 提醒次数、运行状态、附加信息长度
+RESULT = struct.Struct("=8qiI")
+MSG_MAX = 4096
+
 RLIMIT_INFINITY = (1 << (8 * ctypes.sizeof(ctypes.c_long))) - 1
 
 class SandboxFatalError(Exception):
@@ -61,14 +69,63 @@ def relay(src: int, dst: int, side: int):
         error(err)
     _cnt[side] = cnt
 
+def read_exact(fd: int, n: int) -> bytes:
+    buf = b""
+    while len(buf) < n and (data := os.read(fd, n - len(buf))):
+        buf += data
+    return buf
+def read_result(read, limit: Limit) -> Verdict:
+    """
+    通过 read(n) 读取一条二进制结果记录，记录不完整时引发 SandboxFatalError。
+    """
+    head = read(RESULT.size)
+    if len(head) < RESULT.size:
+        raise SandboxFatalError("沙箱结果记录不完整。")
+    t, mem, wall, nvcsw, nivcsw, minflt, majflt, notif, stat, msg_len = RESULT.unpack(head)
+    data = read(msg_len) if msg_len else b""
+    if len(data) < msg_len:
+        raise SandboxFatalError("沙箱结果记录不完整。")
+    if stat == -1:
+        return Verdict(verdict="fail")
+    msg = ""
+    if stat & FBD:
+        verdict = "fb"
+        msg = f"syscall {stat ^ FBD}"
+    elif (stat & TLE) or limit.tl(t):
+        verdict = "tl"
+    elif (stat & MLE) or limit.ml(mem):
+        stat |= MLE
+        verdict = "ml"
+    elif stat & OLE:
+        verdict = "ol"
+    elif stat & SIG:
+        verdict = "re"
+        msg = f"signal {stat ^ SIG}"
+    elif stat & EXIT and stat ^ EXIT:
+        verdict = "re"
+        msg = f"return {stat ^ EXIT}"
+    else:
+        verdict = "ok"
+    for i, s in enumerate(data.decode(errors="replace").splitlines()):
+        if i >= 2:
+            msg += "\n    "
+        else:
+            msg += "\n  "
+        msg += s
+    return Verdict(verdict=verdict, tm=t, mem=mem, stat=stat, msg=msg, wall=wall, nvcsw=nvcsw, nivcsw=nivcsw, minflt=minflt, majflt=majflt, notif=notif)
+
+def _locate(prog: str):
+    if os.path.isabs(prog):
+        return prog
+    if (s := shutil.which(prog)) is not None:
+        return s
+    raise SandboxFatalError(f"沙箱无法定位文件 {repr(prog)}")
+def _cpuset(cpu: int):
+    return "0" * cpu + "1" + "0" * (os.cpu_count() - cpu - 1)
+_group_local = threading.local()
 class Sandbox():
     def __init__(self, prog: str, args: list[str], limit: Limit = None, cwd: str = None, env: os._Environ = None, stdin = None, stdout = None, stderr = None, permissions: list[tuple[str, int]] = None, isolate = False, trust = False):
-        if os.path.isabs(prog):
-            self.prog = prog
-        elif (s := shutil.which(prog)) is not None:
-            self.prog = s
-        else:
-            raise SandboxFatalError(f"沙箱无法定位文件 {repr(prog)}")
+        self.prog = _locate(prog)
         self.args = args
         self.limit = Limit() if limit is None else limit
         self.cwd = cwd
@@ -79,16 +136,31 @@ class Sandbox():
         self.permissions = [] if permissions is None else permissions
         self.isolate = isolate
         self.cpu = None
+        self._cpu_bound = False
         self.trust = trust
+        self.group: SandboxGroup = getattr(_group_local, "group", None)
         self._child_safe = True
+        self._result_fd = None
     def __enter__(self):
         return self
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.group is not None:
+            self.group.discard(self)
         if self.cpu is not None:
-            release_cpu(self.cpu)
-        self.close()
+            if self._cpu_bound:
+                give_bound_cpu()
+            else:
+                release_cpu(self.cpu)
+        try:
+            self.close()
+        finally:
+            if self._result_fd is not None:
+                os.close(self._result_fd)
+                self._result_fd = None
     def close(self):
-        ori = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # 只有主线程可以设置信号处理函数，其它线程本来也不会收到 SIGINT
+        if main := threading.current_thread() is threading.main_thread():
+            ori = signal.signal(signal.SIGINT, signal.SIG_IGN)
         try:
             if not self._child_safe:
                 try:
@@ -105,36 +177,74 @@ class Sandbox():
                             pass
                 self._child_safe = True
         finally:
-            signal.signal(signal.SIGINT, ori)
-    def start(self):
+            if main:
+                signal.signal(signal.SIGINT, ori)
+    def _take_cpuset(self):
+        if not self.isolate:
+            return "1" * os.cpu_count()
+        if (cpu := take_bound_cpu()) is not None:
+            self.cpu = cpu
+            self._cpu_bound = True
+        else:
+            self.cpu = acquire_cpu()
+        if self.cpu == -1:
+            warning("无可用 CPU，绑定至 CPU 0。")
+            return _cpuset(0)
+        return _cpuset(self.cpu)
+    def _spawn(self):
         if self.trust:
             sandbox = SANDBOX_TINY
         else:
             sandbox = SANDBOX
-        self.ret = os.path.join(self.cwd, random_hash(hash32))
         limit_cmdline = [str(min(x, RLIMIT_INFINITY)) for x in self.limit.cmdline()]
-        if self.isolate:
-            self.cpu = acquire_cpu()
-            if self.cpu == -1:
-                warning("无可用 CPU，绑定至 CPU 0。")
-                cpuset_mask = "1" + "0" * (os.cpu_count() - 1)
-            else:
-                cpuset_mask = "0" * self.cpu + "1" + "0" * (os.cpu_count() - self.cpu - 1)
-        else:
-            cpuset_mask = "1" * os.cpu_count()
+        cpuset_mask = self._take_cpuset()
         permissions_cmdline = [str(len(self.permissions))]
         for file, pm in self.permissions:
             permissions_cmdline.append(file)
             permissions_cmdline.append(str(pm))
-        self._child_safe = False
+        # 沙箱通过继承的管道写端发送结果记录，记录不超过管道缓冲区大小，因此可以在沙箱退出后再读取
+        self._result_fd, result_w = os.pipe()
         try:
-            self.proc = subprocess.Popen([sandbox, self.prog, self.ret, *limit_cmdline, cpuset_mask, *permissions_cmdline, *self.args], cwd=self.cwd, env=self.env, stdin=self.stdin, stdout=self.stdout, stderr=self.stderr, start_new_session=True)
+            self.proc = subprocess.Popen([sandbox, self.prog, str(result_w), *limit_cmdline, cpuset_mask, *permissions_cmdline, *self.args], cwd=self.cwd, env=self.env, stdin=self.stdin, stdout=self.stdout, stderr=self.stderr, pass_fds=(result_w,), start_new_session=True)
         except OSError as err:
             raise SandboxFatalError from err
+        finally:
+            os.close(result_w)
+        self._child_safe = False
+    def _started(self):
+        if self.group is not None:
+            self.group.add(self)
+    def start(self):
+        self._spawn()
+        self._stopped()
+    def _stopped(self):
         while True:
             _, stat = os.waitpid(self.proc.pid, os.WUNTRACED)
             if os.WIFSTOPPED(stat) or os.WIFSIGNALED(stat) or os.WIFEXITED(stat):
                 break # 不应该出现 EXITED，但是还是处理
+        # 取走挂起前发送的准备字节，沙箱提前退出时读到文件结尾
+        os.read(self._result_fd, 1)
+        self._started()
+    async def async_start(self):
+        """
+        start 的异步版本。沙箱挂起前会通过结果记录的管道发送一个字节，因此在事件循环中监听该管道，不必轮询挂起状态。
+        """
+        self._spawn()
+        await self._async_stopped()
+    async def _async_stopped(self):
+        await wait_readable(self._result_fd)
+        # 准备字节紧接着挂起发送，此时 waitpid 至多阻塞几条指令的时间
+        self._stopped()
+    def kill(self):
+        """
+        向沙箱发送 SIGALRM，沙箱会杀死其中的程序并以超时结束。
+        """
+        try:
+            self.proc.send_signal(signal.SIGALRM)
+            if not self._child_safe:
+                self.proc.send_signal(signal.SIGCONT)
+        except ProcessLookupError:
+            pass
     def cont(self):
         try:
             self.proc.send_signal(signal.SIGCONT)
@@ -144,47 +254,141 @@ class Sandbox():
     def wait(self):
         if not self._child_safe:
             self.cont()
-        if self.proc.wait():
-            self.ret = Verdict(verdict="fail")
-            return
+        self._collect(self.proc.wait())
+    async def async_wait(self):
+        """
+        wait 的异步版本，通过 pidfd 等待沙箱退出。
+        """
+        if not self._child_safe:
+            self.cont()
+        await wait_exited(self.proc)
+        self._collect(self.proc.wait())
+    def _collect(self, returncode: int):
+        fd, self._result_fd = self._result_fd, None
         try:
-            file = open(self.ret)
-        except OSError as err:
-            error(err)
-            self.ret = Verdict(verdict="fail")
-            return
-        t = int(file.readline()[:-1])
-        mem = int(file.readline()[:-1])
-        stat = int(file.readline()[:-1])
-        msg = ""
-        if stat & FBD:
-            verdict = "fb"
-            msg = f"syscall {stat ^ FBD}"
-        elif (stat & TLE) or self.limit.tl(t):
-            verdict = "tl"
-        elif (stat & MLE) or self.limit.ml(mem):
-            stat |= MLE
-            verdict = "ml"
-        elif stat & OLE:
-            verdict = "ol"
-        elif stat & SIG:
-            verdict = "re"
-            msg = f"signal {stat ^ SIG}"
-        elif stat & EXIT and stat ^ EXIT:
-            verdict = "re"
-            msg = f"return {stat ^ EXIT}"
+            if returncode:
+                self.ret = Verdict(verdict="fail")
+                return
+            try:
+                self.ret = read_result(functools.partial(read_exact, fd), self.limit)
+            except SandboxFatalError as err:
+                error(err)
+                self.ret = Verdict(verdict="fail")
+        finally:
+            os.close(fd)
+
+class SandboxBatch(Sandbox):
+    """
+    批处理沙箱：一个沙箱进程依次运行同一程序的多个任务，只需启动一次沙箱并注册一次默认权限，适合大量小测试点。
+    开启评测隔离时，提供 cpu 则任务绑定到该 CPU 而不占用它，由调用者保证同一时间只有一个程序使用该 CPU。
+    """
+    def __init__(self, prog: str, args: list[str], cwd: str = None, env: os._Environ = None, stderr = None, isolate = False, trust = False, cpu: int = None):
+        super().__init__(prog, args, None, cwd, env, subprocess.PIPE, subprocess.PIPE, stderr, None, isolate, trust)
+        self._cpu = cpu
+    def _take_cpuset(self):
+        if self.isolate and self._cpu is not None:
+            return _cpuset(self._cpu)
+        return super()._take_cpuset()
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None and hasattr(self, "proc"):
+            self.kill()
+        super().__exit__(exc_type, exc_val, exc_tb)
+    def close(self):
+        if hasattr(self, "proc") and self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+    def start(self):
+        if self.trust:
+            sandbox = SANDBOX_TINY
         else:
-            verdict = "ok"
-        i = 0
-        while s := file.readline()[:-1]:
-            i += 1
-            if i >= 3:
-                msg += "\n    "
-            else:
-                msg += "\n  "
-            msg += s
-        file.close()
-        self.ret = Verdict(verdict=verdict, tm=t, mem=mem, stat=stat, msg=msg)
+            sandbox = SANDBOX
+        self._cpuset_mask = self._take_cpuset()
+        try:
+            self.proc = subprocess.Popen([sandbox, "--batch", self.prog, *self.args], cwd=self.cwd, env=self.env, stdin=self.stdin, stdout=self.stdout, stderr=self.stderr, start_new_session=True)
+        except OSError as err:
+            raise SandboxFatalError from err
+        self._started()
+    def run(self, limit: Limit, cwd: str, stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, permissions: list[tuple[str, int]] = None) -> Verdict:
+        """
+        运行一个任务，stdin 和 stdout 只能是路径，其它值都视为 /dev/null。
+        """
+        permissions = [] if permissions is None else permissions
+        job = [cwd, stdin if isinstance(stdin, str) else "", stdout if isinstance(stdout, str) else ""]
+        job += [str(min(x, RLIMIT_INFINITY)) for x in limit.cmdline()]
+        job += [self._cpuset_mask, str(len(permissions))]
+        for file, pm in permissions:
+            job += [file, str(pm)]
+        try:
+            self.proc.stdin.write(("\n".join(job) + "\n").encode())
+            self.proc.stdin.flush()
+        except BrokenPipeError as err:
+            raise SandboxFatalError("批处理沙箱意外退出。") from err
+        try:
+            return read_result(self.proc.stdout.read, limit)
+        except SandboxFatalError as err:
+            raise SandboxFatalError("批处理沙箱意外退出。") from err
+
+async def wait_readable(fd: int):
+    """
+    在事件循环中等待文件描述符可读。
+    """
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    loop.add_reader(fd, lambda: fut.done() or fut.set_result(None))
+    try:
+        await fut
+    finally:
+        loop.remove_reader(fd)
+async def wait_exited(proc: subprocess.Popen):
+    """
+    在事件循环中等待进程退出（但不回收），系统不支持 pidfd 时退化为在线程池中等待。
+    """
+    try:
+        fd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        await asyncio.get_running_loop().run_in_executor(None, proc.wait)
+        return
+    try:
+        await wait_readable(fd)
+    finally:
+        os.close(fd)
+
+class SandboxGroup():
+    """
+    可以一起终止的一组沙箱。在 bind 的作用范围内启动的沙箱都会加入该组，组被终止后才启动的沙箱也会立即被终止。
+    """
+    def __init__(self):
+        self.killed = False
+        self._boxes: set[Sandbox] = set()
+        self._lock = threading.Lock()
+    @contextmanager
+    def bind(self):
+        prev = getattr(_group_local, "group", None)
+        _group_local.group = self
+        try:
+            yield self
+        finally:
+            _group_local.group = prev
+    def add(self, box: Sandbox):
+        with self._lock:
+            self._boxes.add(box)
+            killed = self.killed
+        if killed:
+            box.kill()
+    def discard(self, box: Sandbox):
+        with self._lock:
+            self._boxes.discard(box)
+    def kill(self):
+        # 持有锁时发送信号，discard 返回后沙箱就不会再收到该组的信号，批处理沙箱可以安全地用于下一个测试点
+        with self._lock:
+            self.killed = True
+            for box in self._boxes:
+                box.kill()
+def current_group() -> SandboxGroup | None:
+    """
+    返回当前线程绑定的沙箱组。
+    """
+    return getattr(_group_local, "group", None)
 
 def run(prog: Program, limit: Limit, cwd: str, env: os._Environ = None, stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, permissions: list[tuple[str, int]] = None, *, trust = False) -> Verdict:
     """
@@ -260,3 +464,45 @@ def run_interactive(prog: Program, interactor: Program, limit: Limit, cwd: str,
             err.add_note("对沙箱发送了 SIGALRM。")
         raise
     return box1.ret, box2.ret
+
+
+async def async_run(prog: Program, limit: Limit, cwd: str, env: os._Environ = None, stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, permissions: list[tuple[str, int]] = None, *, trust = False) -> Verdict:
+    """
+    run 的异步版本，同一个事件循环可以同时驱动多个沙箱。任务被取消时会终止沙箱。
+    """
+    with Sandbox(prog.prog, prog.args, limit, cwd, env, stdopen(stdin), stdopen(stdout, "w"), stdopen(stderr, "w"), permissions, userconf.acquire_judge_isolate(), trust) as box:
+        try:
+            await box.async_start()
+            await box.async_wait()
+        except asyncio.CancelledError:
+            box.kill()
+            raise
+    return box.ret
+async def async_run_interactive(prog: Program, interactor: Program, limit: Limit, cwd: str, env: os._Environ = None, stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, tlog = subprocess.DEVNULL, permissions_prog: list[tuple[str, int]] = None, permissions_interactor: list[tuple[str, int]] = None, *, trust_prog = False, trust_interactor = False) -> tuple[Verdict, Verdict]:
+    """
+    run_interactive 的异步版本。回显交互过程需要中继线程，此时在线程池中调用 run_interactive。
+    """
+    if userconf.acquire_interactor_echo():
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(run_interactive, prog, interactor, limit, cwd, env, stdin, stdout, stderr, tlog, permissions_prog, permissions_interactor, trust_prog=trust_prog, trust_interactor=trust_interactor))
+    if not isinstance(stdout, str):
+        raise ValueError("run_interactive 的 stdout 参数必须是 str 类型。")
+    isolate = userconf.acquire_judge_isolate()
+    if userconf.acquire_interactor_fast_sandbox():
+        trust_prog = trust_interactor = True
+    box1 = box2 = None
+    try:
+        with Sandbox(prog.prog, prog.args, limit, cwd, env, subprocess.PIPE, subprocess.PIPE, stdopen(stderr, "w"), permissions_prog, isolate, trust_prog) as box1:
+            box1._spawn()
+            with Sandbox(interactor.prog, interactor.args + [stdin, stdout], limit, cwd, env, box1.proc.stdout, box1.proc.stdin, stdopen(tlog, "w"), permissions_interactor, isolate, trust_interactor) as box2:
+                # 两个沙箱同时准备，不必等选手程序的沙箱挂起后再启动交互器的沙箱
+                box2._spawn()
+                await asyncio.gather(box1._async_stopped(), box2._async_stopped())
+                box1.cont()
+                box2.cont()
+                await asyncio.gather(box1.async_wait(), box2.async_wait())
+    except asyncio.CancelledError:
+        for box in (box1, box2):
+            if box is not None and hasattr(box, "proc"):
+                box.kill()
+        raise
+    return box1.ret, box2.ret
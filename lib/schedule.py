@@ -0,0 +1,33 @@
+"""
+测试点调度。
+
+在每个子任务内按失败的可能性安排测试点的运行顺序，使错误尽早出现，原顺序中在它之后的测试点可以提前终止（见 jury._Subtask）。评测结果仍按测试点原来的顺序记录和显示。
+
+排列依据依次是：
+- 测试点历史中的失败频率，高的在前；
+- 有历史的测试点按最近的运行时间从短到长排列，在没有历史的测试点之前；
+- 输入文件大小，小的在前。
+"""
+
+from .datafile import size
+from .ds import Test
+from .verdicts import VerdictStore
+
+def _size(path: str):
+    try:
+        return size(path)
+    except (OSError, KeyError):
+        return 0
+def schedule(tests: list[Test], store: VerdictStore = None):
+    """
+    为每个子任务设置 order，即测试点的运行顺序（测试点下标的排列）。
+    """
+    for test in tests:
+        infiles = [infile for infile, _ in test.tests]
+        history = {} if store is None else store.history(infiles)
+        def key(i: int):
+            if (x := history.get(infiles[i])) is None:
+                return 0, 1, 0, _size(infiles[i]), i
+            fail, tm = x
+            return -fail, 0, tm, _size(infiles[i]), i
+        test.order = sorted(range(len(infiles)), key=key)
@@ -2,9 +2,36 @@ from .ds import SimpleModel
 
 class UserJudgeConf(SimpleModel):
     isolate: bool = True
+    jobs: int = 1
+    batch: bool = True
+    tmpfs: bool = True
+    memfd: bool = False
+    verdict_cache: bool = True
+    output_store: bool = False
+    check_cache: bool = True
+    identical_ac: bool = False
+    schedule: bool = True
 UserJudge = UserJudgeConf()
 def acquire_judge_isolate():
     return UserJudge.isolate
+def acquire_judge_jobs():
+    return UserJudge.jobs
+def acquire_judge_batch():
+    return UserJudge.batch
+def acquire_judge_tmpfs():
+    return UserJudge.tmpfs
+def acquire_judge_memfd():
+    return UserJudge.memfd
+def acquire_judge_verdict_cache():
+    return UserJudge.verdict_cache
+def acquire_judge_output_store():
+    return UserJudge.output_store
+def acquire_judge_check_cache():
+    return UserJudge.check_cache
+def acquire_judge_identical_ac():
+    return UserJudge.identical_ac
+def acquire_judge_schedule():
+    return UserJudge.schedule
 
 class UserInteractorConf(SimpleModel):
     fast_sandbox: bool = False
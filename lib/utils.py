@@ -1,11 +1,18 @@
 import decimal
+import fcntl
 import hashlib
+import json
+import mmap
 import os
 import random
+import re
 import shutil
 import tempfile
+import threading
+import time
 import zipfile
-from functools import cmp_to_key, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from itertools import chain
 from typing import Callable
 
@@ -201,11 +208,33 @@ def get_unique_path(cwd: str, func = hash32, ed = "a"):
     return ret
 
 # hashlib 扩展
-def hash_file(path: str, func: Callable[[], "hashlib._Hash"] = hashlib.md5, /, trunk = 8192):
+HASH_TRUNK = 1 << 20
+HASH_MMAP = 1 << 24 # 不小于此大小的文件使用 mmap 读取
+HASH_JOBS = min(8, os.cpu_count() or 1)
+HASH_PARALLEL = 1 << 16 # 不小于此大小的文件由线程池并行计算哈希
+def digest_func():
+    """
+    内容寻址使用的哈希函数。BLAKE2b 比 SHA3 快得多，并且在计算大块数据时释放 GIL，可以多线程并行计算。
+    """
+    return hashlib.blake2b(digest_size=32)
+def hash_file(path: str, func: Callable[[], "hashlib._Hash"] = hashlib.md5, /, trunk = HASH_TRUNK):
     ret = func()
     with open(path, "rb") as file:
-        while block := file.read(trunk):
-            ret.update(block)
+        if (size := os.fstat(file.fileno()).st_size) < trunk:
+            ret.update(file.read())
+            return ret
+        if size >= HASH_MMAP:
+            try:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    buf.madvise(mmap.MADV_SEQUENTIAL)
+                    ret.update(buf)
+                return ret
+            except (OSError, ValueError):
+                pass
+        buf = bytearray(trunk)
+        view = memoryview(buf)
+        while n := file.readinto(buf):
+            ret.update(view[:n])
     return ret
 
 # TODO 改用 pathlib
@@ -246,61 +275,154 @@ def copy_to(src: str, dst: str):
         shutil.copytree(src, os.path.join(dst, os.path.basename(src)))
     else:
         shutil.copyfile(src, os.path.join(dst, os.path.basename(src)))
+FICLONE = 0x40049409 # linux/fs.h
+def link_file(src: str, dst: str):
+    """
+    不复制数据地将文件 src 提供到路径 dst：依次尝试硬链接和 reflink（FICLONE），文件系统都不支持时才复制。
+    硬链接与 src 共享同一个 inode，dst 只能用于只读的场合（例如沙箱中只有读权限的文件）。
+    """
+    try:
+        os.link(src, dst)
+        return dst
+    except OSError:
+        pass
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return dst
+    except OSError:
+        pass
+    return shutil.copyfile(src, dst)
+def link_to(src: str, dst: str):
+    """
+    将 src 以只读方式提供到 dst 目录下，目录中的每个文件都使用 link_file。
+    """
+    if os.path.isdir(src):
+        shutil.copytree(src, os.path.join(dst, os.path.basename(src)), copy_function=link_file)
+    else:
+        link_file(src, os.path.join(dst, os.path.basename(src)))
 
 # 路径排序
-path_sort_type = tuple[str, list[str | int]]
-@lru_cache(8192)
-def path_cut_for_sort(path: str):
-    def _foo(x: str):
-        ret: list[str] = []
-        for c in x:
-            if not ret or ret[-1].isdigit() != c.isdigit() or ret[-1] == "." or c == ".":
-                ret.append(c)
-            else:
-                ret[-1] += c
-        for i in range(len(ret)):
-            if ret[i].isdigit():
-                ret[i] = int(ret[i])
-        return ret
-    return os.path.dirname(path), _foo(os.path.basename(path))
-def path_cmp(x: str, y: str):
-    x = path_cut_for_sort(x)
-    y = path_cut_for_sort(y)
-    def _foo(a, b):
-        if a < b:
-            return -1
-        elif b < a:
-            return 1
-        return 0
-    if x[0] != y[0]:
-        return _foo(x[0], y[0])
-    for i in range(min(len(x[1]), len(y[1]))):
-        if x[1][i] != y[1][i]:
-            if x[1][i] == ".":
-                return -1
-            if y[1][i] == ".":
-                return 1
-            if type(x[1][i]) != type(y[1][i]):
-                return 1 if isinstance(x[1][i], int) else -1
-            return _foo(x[1][i], y[1][i])
-    return _foo(len(x[1]), len(y[1]))
-path_cmp = cmp_to_key(path_cmp)
+# 先按所在目录排序，同一目录下按文件名自然排序：文件名切分为数字段、非数字段和 "."，数字段按数值比较，"." 小于其它段，非数字段小于数字段
+_name_chunk = re.compile(r"\d+|\.|[^\d.]+")
+def name_key(name: str) -> tuple[tuple[int, str | int], ...]:
+    """
+    文件名的自然排序键。
+    """
+    return tuple((0, "") if x == "." else (2, int(x)) if x[0].isdigit() else (1, x) for x in _name_chunk.findall(name))
+def path_key(path: str):
+    """
+    路径的排序键，用于 sort 的 key 参数。
+    """
+    dirname, name = os.path.split(path)
+    return dirname, name_key(name)
 
 # 存档管理
+# 存档以内容寻址：编译产物存放在 objects 目录下，以源文件、编译参数和编译器信息的哈希命名。
+# 写入时先写临时文件再原子地重命名，多个进程同时写入同一存档也是安全的；读取时使用硬链接或 reflink 提供存档，不复制数据。
+# 存档总大小超过 CACHE_LIMIT 时按最近使用时间（修改时间，命中时更新）淘汰。
+CACHE_LIMIT = GiB(1)
 _cache_dir = os.path.expanduser("~/.cache/selfeval-persistent-cache")
-_cache_magic = b"EVAL\x01\x05\x00\x00"
-_cache_comment = b"This file is automatically generated by selfeval version 1.5.0 for cache usage. Please DO NOT modify it unless you know what you're doing. You can remove it from your computer safely. "
+_cache_objects = os.path.join(_cache_dir, "objects")
+_cache_index = os.path.join(_cache_dir, "digests.json")
+_cache_index_max = 1 << 16
+_cache_lock = threading.Lock()
+_cache_stat: dict[str, list] | None = None
+_cache_stat_dirty = False
+# 本进程所知的存档总大小，第一次添加存档时统计，超过 CACHE_LIMIT 时才重新统计并淘汰，其它进程添加的存档在重新统计时计入
+_cache_size: int | None = None
+def _load_stat():
+    global _cache_stat
+    if _cache_stat is None:
+        try:
+            with open(_cache_index) as file:
+                _cache_stat = json.load(file)
+            if not isinstance(_cache_stat, dict):
+                raise ValueError(_cache_stat)
+        except (OSError, ValueError):
+            _cache_stat = {}
+    return _cache_stat
+def _save_stat():
+    global _cache_stat_dirty
+    if not _cache_stat_dirty:
+        return
+    _cache_stat_dirty = False
+    while len(_cache_stat) > _cache_index_max:
+        del _cache_stat[next(iter(_cache_stat))]
+    tmp = get_unique_path(_cache_dir) + ".tmp"
+    try:
+        with open(tmp, "w") as file:
+            json.dump(_cache_stat, file)
+        os.replace(tmp, _cache_index)
+    except OSError:
+        with suppress(OSError):
+            os.remove(tmp)
+def file_digests(paths: list[str]) -> list[str]:
+    """
+    返回多个文件内容的哈希（十六进制）。索引以 (设备号, inode) 为键，文件的大小和修改时间与索引中记录的相同时直接使用记录的哈希，不重新读取文件；需要读取的文件由线程池并行计算。
+    """
+    global _cache_stat_dirty
+    ret: list[str | None] = []
+    todo: list[tuple[int, str, str, list[int]]] = []
+    with _cache_lock:
+        index = _load_stat()
+        for i, path in enumerate(paths):
+            st = os.stat(path)
+            key = f"{st.st_dev}:{st.st_ino}"
+            stamp = [st.st_size, st.st_mtime_ns]
+            if (x := index.pop(key, None)) is not None and x[:2] == stamp:
+                index[key] = x
+                ret.append(x[2])
+            else:
+                ret.append(None)
+                todo.append((i, path, key, stamp))
+    if not todo:
+        return ret
+    # 小文件的哈希计算很快，交给线程池的开销反而更大
+    large = [x for x in todo if x[3][0] >= HASH_PARALLEL]
+    digests = {}
+    if len(large) > 1:
+        with ThreadPoolExecutor(HASH_JOBS) as pool:
+            digests = dict(zip((x[0] for x in large), pool.map(lambda x: hash_file(x[1], digest_func).hexdigest(), large)))
+    for i, path, key, stamp in todo:
+        if i not in digests:
+            digests[i] = hash_file(path, digest_func).hexdigest()
+    now = time.time_ns()
+    with _cache_lock:
+        index = _load_stat()
+        for i, path, key, stamp in todo:
+            ret[i] = digest = digests[i]
+            # 刚修改过的文件可能在同一时间戳内再次被修改，不记录
+            if now - stamp[1] >= 2 * 10**9:
+                index[key] = stamp + [digest]
+                _cache_stat_dirty = True
+        _save_stat()
+    return ret
+def file_digest(path: str):
+    """
+    返回文件内容的哈希（十六进制），未修改的文件使用索引中记录的哈希，见 file_digests。
+    """
+    return file_digests([path])[0]
+def cache_file(name: str):
+    """
+    返回缓存目录下名为 name 的文件的路径，缓存不可用时返回 None。
+    """
+    if CACHE_DISABLED:
+        return
+    cache_init()
+    if os.path.isdir(_cache_dir):
+        return os.path.join(_cache_dir, name)
 def _cache_hash(files: list[str], args: list[str], info: str):
     try:
-        sha512 = hashlib.sha3_512()
-        for x in sorted(map(lambda x: int(x.hexdigest(), 16), chain((hash_file(file, hashlib.sha3_512) for file in files), (hashlib.sha3_512(arg.encode()) for arg in args), (hashlib.sha3_512(info.encode()), )))):
-            sha512.update(x.to_bytes(512))
-        sha512 = sha512.hexdigest()
-    except TypeError as err:
+        ret = digest_func()
+        for x in sorted(chain(file_digests(files), (hashlib.blake2b(arg.encode(), digest_size=32).hexdigest() for arg in args), (hashlib.blake2b(info.encode(), digest_size=32).hexdigest(), ))):
+            ret.update(bytes.fromhex(x))
+        ret = ret.hexdigest()
+    except (TypeError, OSError) as err:
         err.add_note("无法创建哈希。")
         error(err)
         return
-    return sha512
+    return ret
 def cache_init():
     if CACHE_DISABLED:
         return
@@ -308,83 +430,95 @@ def cache_init():
         if os.path.exists(_cache_dir):
             ensure_removed(_cache_dir)
         try:
-            os.mkdir(_cache_dir, 0o700)
+            os.makedirs(_cache_dir, 0o700, True)
         except FileExistsError:
-            if os.path.isdir(_cache_dir):
-                warning("无法创建缓存，路径被占用。")
-            else:
-                error("无法创建缓存，路径被占用且不是目录。", True)
+            error("无法创建缓存，路径被占用且不是目录。", True)
+            return
+    try:
+        os.makedirs(_cache_objects, 0o700, True)
+    except FileExistsError:
+        error("无法创建缓存，路径被占用且不是目录。", True)
 def cache_clear():
+    global _cache_stat, _cache_stat_dirty, _cache_size
+    with _cache_lock:
+        _cache_stat = None
+        _cache_stat_dirty = False
+        _cache_size = None
     if os.path.exists(_cache_dir):
         ensure_removed(_cache_dir)
-def cache_add(path: str, files: list[str], args: list[str], info: str, /, comment: str = _cache_comment):
+def _cache_evict():
+    global _cache_size
+    try:
+        with os.scandir(_cache_objects) as it:
+            entries = []
+            for entry in it:
+                if entry.is_file(follow_symlinks=False) and not entry.name.endswith(".tmp"):
+                    st = entry.stat(follow_symlinks=False)
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+    except OSError:
+        return
+    total = sum(x[1] for x in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_LIMIT:
+            break
+        with suppress(OSError):
+            os.remove(path)
+            total -= size
+    with _cache_lock:
+        _cache_size = total
+def cache_add(path: str, files: list[str], args: list[str], info: str):
+    """
+    将文件 path 存档，存档以 files 的内容、args 和 info 为键。
+    """
+    global _cache_size
     if CACHE_DISABLED:
         return
     cache_init()
-    if not os.path.isdir(_cache_dir):
+    if not os.path.isdir(_cache_objects):
         return
-    if (sha512 := _cache_hash(files, args, info)) is None:
+    if (key := _cache_hash(files, args, info)) is None:
         return
+    tmp = get_unique_path(_cache_objects) + ".tmp"
     try:
-        with open(path, "rb") as file:
-            content = file.read()
-    except OSError as err:
-        err.add_note(f"无法读取要存档的文件 {repr(path)}")
-        error(err)
-        return
-    try:
-        with open(os.path.join(_cache_dir, sha512), "wb") as file:
-            file.write(_cache_magic)
-            file.write((os.stat(path).st_mode & 0o777).to_bytes(2))
-            file.write(len(comment).to_bytes(2))
-            file.write(comment)
-            file.write(len(content).to_bytes(8))
-            file.write(content)
+        link_file(path, tmp)
+        os.chmod(tmp, 0o555)
+        size = os.stat(tmp).st_size
+        os.replace(tmp, os.path.join(_cache_objects, key))
     except OSError as err:
+        with suppress(OSError):
+            os.remove(tmp)
         err.add_note("无法创建存档。")
         error(err)
         return
-def cache_get(files: list[str], args: list[str], info: str, /, dst: str = None):
-    cache_init()
-    if CACHE_DISABLED or not os.path.isdir(_cache_dir):
-        return
-    if (sha512 := _cache_hash(files, args, info)) is None:
-        return
-    if not os.path.isfile(path := os.path.join(_cache_dir, sha512)):
+    # 替换同名存档时会多计大小，只会使重新统计提前
+    with _cache_lock:
+        if _cache_size is not None:
+            _cache_size += size
+        full = _cache_size is None or _cache_size > CACHE_LIMIT
+    if full:
+        _cache_evict()
+def cache_get(files: list[str], args: list[str], info: str, dst: str):
+    """
+    查找以 files 的内容、args 和 info 为键的存档，找到时将其以只读可执行文件提供到路径 dst 并返回 dst，否则返回 None。
+    """
+    if CACHE_DISABLED or not os.path.isdir(_cache_objects):
         return
-    try:
-        with open(path, "rb") as file:
-            if (head := file.read(8)) != _cache_magic:
-                warning(f"读取的存档头无法识别 {head} != {_cache_magic}，将忽略存档。")
-                return
-            mode = int.from_bytes(file.read(2))
-            if (mode & 0o777) != mode:
-                warning(f"读取的存档权限位 {mode} 无法识别，将忽略存档。")
-                return
-            comment = file.read(x := int.from_bytes(file.read(2)))
-            content = file.read(x := int.from_bytes(file.read(8)))
-            if len(content) != x:
-                warning(f"期望读取 {x} 字节的存档，实际读取 {len(content)} 字节，将忽略存档。")
-                return
-    except (OSError, ValueError) as err:
-        err.add_note("无法读取存档。")
-        error(err)
+    if (key := _cache_hash(files, args, info)) is None:
         return
-    fd, path = tempfile.mkstemp(prefix="selfeval-archive-extract-cache-", dir=dst)
+    path = os.path.join(_cache_objects, key)
     try:
-        os.fchmod(fd, mode)
-    except PermissionError as err:
-        err.add_note("无法设置权限位，将忽略存档。")
-        ensure_removed(path)
+        os.utime(path)
+        link_file(path, dst)
+        os.chmod(dst, 0o555)
+    except FileNotFoundError:
         return
-    try:
-        with os.fdopen(fd, "wb") as file:
-            file.write(content)
     except OSError as err:
-        err.add_note("无法写入提取出的存档，将忽略存档。")
-        ensure_removed(path)
+        err.add_note("无法读取存档。")
+        error(err)
+        with suppress(OSError):
+            os.remove(dst)
         return
-    return path
+    return dst
 
 # 数据管理
 def backup(src: str, dst: str, compression=0, compresslevel=None):
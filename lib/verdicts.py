@@ -0,0 +1,352 @@
+"""
+评测结果存储。
+
+同一个测试点的评测结果只取决于选手程序、输入文件、答案文件、校验器（或内置比较方式）、交互器和限制，这些都相同时直接使用上次的评测结果，不再运行选手程序。
+沙箱程序和影响运行结果的评测选项（评测隔离、memfd 输出等）也是键的一部分，重新编译沙箱后之前的结果失效。
+结果存放在缓存目录下的 SQLite 数据库中，以上述内容的哈希为键；校验器运行失败（fail）、被忽略（ig）和超时（tl）的结果不存储，超时与机器负载有关。
+
+可选的输出存储记录选手程序的运行结果和输出，以选手程序、输入文件和限制为键。只有校验器变化时，从存储中取出输出重新校验，不需要再运行选手程序。
+输出以内容寻址、压缩存放在缓存目录下的 outputs 目录中，总大小超过 OUTPUT_LIMIT 时按最近使用时间淘汰。交互题不使用输出存储。
+
+校验结果缓存记录校验器对 (输入, 输出, 答案) 的校验结果，以校验器和三个文件的哈希为键，相同的输出不再运行校验器。
+
+测试点历史以输入文件的路径为键，记录测试点失败的频率和最近的运行时间，供 schedule 模块安排运行顺序。
+"""
+
+import decimal
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import suppress
+
+from . import userconf
+from .core import warning
+from .datafile import digests, is_plain
+from .ds import Program, TestConf, JudgeConf, Verdict
+from .sandbox import SANDBOX, SANDBOX_TINY, TLE
+from .utils import GiB, cache_file, digest_func, file_digest, file_digests, get_unique_path, hash_file
+
+# 超过此时间未使用的结果会被删除
+EXPIRE = 30 * 86400
+OUTPUT_LIMIT = GiB(1)
+TRUNK = 1 << 20
+
+def _digest(path: str):
+    if os.path.isdir(path):
+        ret = digest_func()
+        files = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            files += (os.path.join(dirpath, name) for name in sorted(filenames))
+        for p, digest in zip(files, file_digests(files)):
+            ret.update(os.path.relpath(p, path).encode())
+            ret.update(digest.encode())
+        return ret.hexdigest()
+    return digests([path])[0]
+def _key(data):
+    return hashlib.blake2b(json.dumps(data).encode(), digest_size=32).hexdigest()
+def _program(prog: Program | str | None):
+    if not isinstance(prog, Program):
+        return prog
+    return [_digest(prog.prog), prog.args]
+def _sandbox():
+    # 沙箱程序和影响运行结果的评测选项
+    return [
+        [_digest(x) if os.path.exists(x) else None for x in (SANDBOX, SANDBOX_TINY)],
+        userconf.acquire_judge_isolate(),
+        userconf.acquire_judge_memfd(),
+        userconf.acquire_interactor_fast_sandbox(),
+    ]
+def _timeout(ret: Verdict):
+    return ret.verdict == "tl" or bool(ret.stat & TLE)
+def _dump(ret: Verdict):
+    data = {k: v for k, v in vars(ret).items() if k != "cached"}
+    if data["score"] is not None:
+        data["score"] = str(data["score"])
+    return json.dumps(data)
+def _load(data: str):
+    data = json.loads(data)
+    if data["score"] is not None:
+        data["score"] = decimal.Decimal(data["score"])
+    return Verdict(**data)
+
+class VerdictStore():
+    """
+    评测结果存储。rejudge 为 all 时不使用存储的结果（仍然记录新的结果），为 failed 时只使用存储的 ac 结果。
+    verdicts、outputs 和 checks 分别控制是否使用评测结果存储、输出存储和校验结果缓存，重新评测时不使用存储的输出。
+    """
+    def __init__(self, prog: Program, conf: JudgeConf, rejudge = "", *, verdicts = True, outputs = False, checks = False):
+        self.rejudge = rejudge
+        self.verdicts = verdicts
+        self.outputs = outputs and not conf.interactor
+        self.checks = checks and conf.checker is not None
+        self._checker = None
+        self._lock = threading.Lock()
+        self._db = None
+        self._base = self._run = None
+        self._blobs = None
+        self._blobs_size = 0
+        if (path := cache_file("verdicts.db")) is None:
+            return
+        try:
+            # 选手程序的运行只与程序、文件名、附加文件和沙箱有关，评测结果还与校验器和交互器有关
+            self._run = json.dumps([
+                _program(prog),
+                conf.name,
+                [_digest(x) for x in conf.additional],
+                conf.retry,
+                _sandbox(),
+            ])
+            self._base = json.dumps([
+                self._run,
+                _program(conf.checker),
+                _program(conf.interactor),
+                conf.checker_conf.compare if conf.checker is None else conf.checker_conf.limit.cmdline(),
+            ])
+            if self.checks:
+                self._checker = json.dumps([_program(conf.checker), conf.checker_conf.limit.cmdline()])
+            self._db = sqlite3.connect(path, 10, isolation_level=None, check_same_thread=False)
+            # 每个测试点都会读写数据库，不需要每次提交都同步到磁盘
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, data TEXT NOT NULL, used REAL NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS outputs (key TEXT PRIMARY KEY, blob TEXT, data TEXT NOT NULL, used REAL NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS checks (key TEXT PRIMARY KEY, data TEXT NOT NULL, used REAL NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS history (test TEXT PRIMARY KEY, fail REAL NOT NULL, time INTEGER NOT NULL, used REAL NOT NULL)")
+            for table in ("verdicts", "outputs", "checks", "history"):
+                self._db.execute(f"DELETE FROM {table} WHERE used < ?", (time.time() - EXPIRE, ))
+            if self.outputs:
+                self._blobs = cache_file("outputs")
+                os.makedirs(self._blobs, 0o700, True)
+                with os.scandir(self._blobs) as it:
+                    self._blobs_size = sum(entry.stat().st_size for entry in it if entry.is_file())
+        except (OSError, sqlite3.Error) as err:
+            warning(f"无法打开评测结果存储：{err}")
+            self.close()
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+    def prefetch(self, files: list[str]):
+        """
+        并行计算 files 的哈希并记录到文件哈希索引中，之后计算各测试点的键时不需要再读取文件。
+        """
+        if self._db is None or not (self.verdicts or self._blobs is not None or self._checker is not None):
+            return
+        with suppress(OSError):
+            digests(files)
+    def key(self, testconf: TestConf, infile: str, ansfile: str):
+        if self._db is None or not self.verdicts:
+            return
+        try:
+            return _key([self._base, _digest(infile), _digest(ansfile), testconf.limit.cmdline()])
+        except OSError:
+            return
+    def get(self, key: str | None):
+        """
+        查找存储的评测结果，没有找到或按 rejudge 不使用时返回 None。返回的结果 cached 为真。
+        """
+        if key is None or self.rejudge == "all":
+            return
+        try:
+            with self._lock:
+                if self._db is None or (row := self._db.execute("SELECT data FROM verdicts WHERE key = ?", (key, )).fetchone()) is None:
+                    return
+                self._db.execute("UPDATE verdicts SET used = ? WHERE key = ?", (time.time(), key))
+            ret = _load(row[0])
+        except (sqlite3.Error, ValueError, TypeError, KeyError, decimal.DecimalException):
+            return
+        if self.rejudge == "failed" and ret.verdict != "ac":
+            return
+        ret.cached = True
+        return ret
+    def put(self, key: str | None, ret: Verdict):
+        if key is None or ret.verdict in ("ig", "fail") or _timeout(ret):
+            return
+        try:
+            with self._lock:
+                if self._db is not None:
+                    self._db.execute("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)", (key, _dump(ret), time.time()))
+        except sqlite3.Error as err:
+            warning(f"无法存储评测结果：{err}")
+
+    def output_key(self, testconf: TestConf, infile: str):
+        if self._db is None or self._blobs is None:
+            return
+        try:
+            return _key([self._run, _digest(infile), testconf.limit.cmdline()])
+        except OSError:
+            return
+    def load_output(self, key: str | None, stdout: str):
+        """
+        查找存储的运行结果，找到时将输出写入 stdout 并返回运行结果，否则返回 None。
+        """
+        if key is None or self.rejudge:
+            return
+        try:
+            with self._lock:
+                if self._db is None or (row := self._db.execute("SELECT blob, data FROM outputs WHERE key = ?", (key, )).fetchone()) is None:
+                    return
+                self._db.execute("UPDATE outputs SET used = ? WHERE key = ?", (time.time(), key))
+            ret = _load(row[1])
+            if row[0] is not None:
+                path = os.path.join(self._blobs, row[0])
+                os.utime(path)
+                dec = zlib.decompressobj()
+                with open(path, "rb") as fin, open(stdout, "wb") as fout:
+                    while data := fin.read(TRUNK):
+                        fout.write(dec.decompress(data))
+                    fout.write(dec.flush())
+                if not dec.eof:
+                    return
+        except (OSError, zlib.error, sqlite3.Error, ValueError, TypeError, KeyError, decimal.DecimalException):
+            return
+        return ret
+    def save_output(self, key: str | None, ret: Verdict, stdout: str):
+        """
+        存储运行结果。只有正常结束（ok）时才存储输出，其它运行结果不会运行校验器。超时的运行结果不存储。
+        """
+        if key is None or _timeout(ret):
+            return
+        blob = None
+        if ret.verdict == "ok":
+            tmp = get_unique_path(self._blobs) + ".tmp"
+            try:
+                sha = digest_func()
+                com = zlib.compressobj(1)
+                with open(stdout, "rb") as fin, open(tmp, "wb") as fout:
+                    while data := fin.read(TRUNK):
+                        sha.update(data)
+                        fout.write(com.compress(data))
+                    fout.write(com.flush())
+                blob = sha.hexdigest()
+                size = os.stat(tmp).st_size
+                # 相同的输出只存储一份
+                if os.path.exists(path := os.path.join(self._blobs, blob)):
+                    os.remove(tmp)
+                    os.utime(path)
+                else:
+                    os.replace(tmp, path)
+                    with self._lock:
+                        self._blobs_size += size
+            except OSError as err:
+                with suppress(OSError):
+                    os.remove(tmp)
+                warning(f"无法存储输出：{err}")
+                return
+        try:
+            with self._lock:
+                if self._db is not None:
+                    self._db.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)", (key, blob, _dump(ret), time.time()))
+        except sqlite3.Error as err:
+            warning(f"无法存储运行结果：{err}")
+        if self._blobs_size > OUTPUT_LIMIT:
+            self._evict()
+    def _evict(self):
+        try:
+            with os.scandir(self._blobs) as it:
+                entries = []
+                for entry in it:
+                    if entry.is_file() and not entry.name.endswith(".tmp"):
+                        st = entry.stat()
+                        entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(x[1] for x in entries)
+        # 淘汰到上限的一半，避免频繁扫描目录
+        for _, size, path in sorted(entries):
+            if total <= OUTPUT_LIMIT // 2:
+                break
+            with suppress(OSError):
+                os.remove(path)
+                total -= size
+        with self._lock:
+            self._blobs_size = total
+
+    def check_key(self, infile: str, outfile: str, ansfile: str, out: str = None):
+        """
+        返回校验结果的键。out 是已经计算出的输出文件的哈希。
+        """
+        if self._db is None or self._checker is None:
+            return
+        try:
+            if out is None:
+                out = output_digest(outfile)
+            return _key([self._checker, _digest(infile), out, _digest(ansfile)])
+        except OSError:
+            return
+    def get_check(self, key: str | None) -> tuple[str, str, decimal.Decimal | None] | None:
+        """
+        查找缓存的校验结果 (结果, 附加信息, 分数)。
+        """
+        if key is None:
+            return
+        try:
+            with self._lock:
+                if self._db is None or (row := self._db.execute("SELECT data FROM checks WHERE key = ?", (key, )).fetchone()) is None:
+                    return
+                self._db.execute("UPDATE checks SET used = ? WHERE key = ?", (time.time(), key))
+            verdict, msg, score = json.loads(row[0])
+            return verdict, msg, None if score is None else decimal.Decimal(score)
+        except (sqlite3.Error, ValueError, TypeError, decimal.DecimalException):
+            return
+    def put_check(self, key: str | None, verdict: str, msg: str, score: decimal.Decimal | None):
+        if key is None or verdict == "fail":
+            return
+        try:
+            with self._lock:
+                if self._db is not None:
+                    self._db.execute("INSERT OR REPLACE INTO checks VALUES (?, ?, ?)", (key, json.dumps([verdict, msg, None if score is None else str(score)]), time.time()))
+        except sqlite3.Error as err:
+            warning(f"无法存储校验结果：{err}")
+
+    def history(self, infiles: list[str]) -> dict[str, tuple[float, int]]:
+        """
+        返回测试点历史，将输入文件映射到 (失败频率, 最近的运行时间)，没有历史的测试点不在其中。
+        """
+        ret = {}
+        try:
+            with self._lock:
+                if self._db is None:
+                    return ret
+                for infile in infiles:
+                    if (row := self._db.execute("SELECT fail, time FROM history WHERE test = ?", (os.path.abspath(infile), )).fetchone()) is not None:
+                        ret[infile] = row
+        except sqlite3.Error:
+            pass
+        return ret
+    def record(self, infile: str, ret: Verdict):
+        """
+        记录测试点的评测结果。失败频率按指数衰减，最近的结果权重最大。
+        """
+        if ret.verdict in ("ig", "fail") or ret.cached:
+            return
+        infile = os.path.abspath(infile)
+        failed = 1.0 if ret.verdict != "ac" else 0.0
+        try:
+            with self._lock:
+                if self._db is not None:
+                    row = self._db.execute("SELECT fail FROM history WHERE test = ?", (infile, )).fetchone()
+                    fail = failed if row is None else (row[0] + failed) / 2
+                    self._db.execute("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)", (infile, fail, ret.tm, time.time()))
+        except sqlite3.Error as err:
+            warning(f"无法记录测试点历史：{err}")
+
+def output_digest(path: str):
+    """
+    返回选手输出文件的哈希。选手输出是临时文件（可能是 memfd），不记录到文件哈希索引中。
+    """
+    return hash_file(path, digest_func).hexdigest()
+def identical(outfile: str, ansfile: str):
+    """
+    判断输出文件与答案文件是否完全相同，返回 (是否相同, 输出文件的哈希)。大小不同时不计算哈希。答案文件的哈希来自文件哈希索引，不需要重新读取。
+    压缩的答案文件的哈希不是内容的哈希，不作判断。
+    """
+    if not is_plain(ansfile) or os.stat(outfile).st_size != os.stat(ansfile).st_size:
+        return False, None
+    out = output_digest(outfile)
+    return out == file_digest(ansfile), out
@@ -0,0 +1,115 @@
+"""
+基于 inotify 的文件监视，用于 --watch 模式。
+
+只监视目录：编辑器保存文件时常常写入临时文件再重命名，直接监视文件会丢失之后的修改。
+"""
+
+import ctypes
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+_EVENT = struct.Struct("iIII")
+
+def ignored(name: str):
+    """
+    判断是否是编辑器产生的临时文件。
+    """
+    return name.startswith(".") or name.endswith(("~", ".swp", ".swx")) or name == "4913"
+
+class Watcher():
+    """
+    监视一组目录中的文件变化。
+    """
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        if (fd := self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)) == -1:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.fd = fd
+        self._dirs: dict[int, str] = {}
+        self._recursive: set[str] = set()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    def close(self):
+        if self.fd != -1:
+            os.close(self.fd)
+            self.fd = -1
+    def _add(self, path: str):
+        if (wd := self._libc.inotify_add_watch(self.fd, os.fsencode(path), MASK)) == -1:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self._dirs[wd] = path
+    def add(self, path: str, recursive = False):
+        """
+        监视目录 path。recursive 为真时同时监视所有子目录，包括之后新建的子目录。重复添加同一目录没有副作用。
+        """
+        path = os.path.abspath(path)
+        self._add(path)
+        if recursive:
+            self._recursive.add(path)
+            for dirpath, dirnames, filenames in os.walk(path):
+                for name in dirnames:
+                    self._add(os.path.join(dirpath, name))
+    def _read(self, changed: set[str]):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = os.fsdecode(data[pos:pos+length].rstrip(b"\0"))
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                # 事件队列溢出，无法确定变化的文件，报告所有监视的目录
+                changed.update(self._dirs.values())
+                continue
+            if (dirpath := self._dirs.get(wd)) is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._dirs[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.add(dirpath)
+                continue
+            if ignored(name):
+                continue
+            path = os.path.join(dirpath, name)
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and any(path.startswith(x + os.sep) for x in self._recursive):
+                try:
+                    self.add(path, True)
+                except OSError:
+                    pass
+    def wait(self, debounce = 0.2):
+        """
+        阻塞直到有文件变化，并等待变化停止 debounce 秒，返回变化的路径集合。
+        """
+        changed: set[str] = set()
+        poll = select.poll()
+        poll.register(self.fd, select.POLLIN)
+        while not changed:
+            poll.poll()
+            self._read(changed)
+        while poll.poll(int(debounce * 1000)):
+            self._read(changed)
+        return changed
@@ -0,0 +1,112 @@
+"""
+评测工作目录池。
+
+工作目录优先创建在 tmpfs（/dev/shm）上，空间不足时退回到磁盘上的缓存目录。用完的工作目录交给后台清理线程清空后回收，删除大文件不再阻塞下一个测试点。
+"""
+
+import atexit
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+from . import userconf
+from .core import DEBUG
+from .utils import get_unique_path
+
+TMPFS = "/dev/shm"
+# tmpfs 上至少保留的空闲空间
+TMPFS_RESERVE = 256 * 2**20
+
+class _Root():
+    def __init__(self, path: str, tmpfs: bool):
+        self.path = path
+        self.tmpfs = tmpfs
+        self.dev = os.stat(path).st_dev
+        self.free: list[str] = []
+        self.reserved = 0 # 已分配但尚未清空的工作目录可能占用的空间
+
+_lock = threading.Lock()
+_roots: dict[str, _Root] = {}
+_tmpfs: _Root | None = None
+_tmpfs_tried = False
+_owner: dict[str, tuple[_Root, int]] = {}
+_reaper: threading.Thread | None = None
+_trash: queue.SimpleQueue = queue.SimpleQueue()
+
+def _get_tmpfs():
+    global _tmpfs, _tmpfs_tried
+    if not _tmpfs_tried:
+        _tmpfs_tried = True
+        try:
+            path = tempfile.mkdtemp(prefix="selfeval-workdir-", dir=TMPFS)
+        except OSError:
+            pass
+        else:
+            _tmpfs = _Root(path, True)
+            atexit.register(shutil.rmtree, path, True)
+    return _tmpfs
+def _get_root(cwd: str):
+    if (root := _roots.get(cwd)) is None:
+        root = _roots[cwd] = _Root(cwd, False)
+    return root
+def _clear(wd: str):
+    try:
+        with os.scandir(wd) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+    except OSError:
+        return False
+    return True
+def _reap():
+    while True:
+        wd = _trash.get()
+        ok = _clear(wd)
+        with _lock:
+            root, need = _owner.pop(wd)
+            root.reserved -= need
+            if ok:
+                root.free.append(wd)
+
+def acquire_workdir(cwd: str, need = 0, links: tuple[str, ...] = ()) -> str:
+    """
+    分配一个空的工作目录。need 是目录中文件可能占用的最大空间，用于判断 tmpfs 是否有足够空间。
+    links 是需要通过硬链接提供到工作目录中的文件，它们与 cwd 位于同一文件系统时使用 cwd 下的工作目录，以免复制。
+    """
+    with _lock:
+        root = _get_root(cwd)
+        if userconf.acquire_judge_tmpfs() and (tmpfs := _get_tmpfs()) is not None and not any(os.stat(x).st_dev == root.dev for x in links):
+            try:
+                st = os.statvfs(tmpfs.path)
+            except OSError:
+                pass
+            else:
+                if st.f_bavail * st.f_frsize - tmpfs.reserved - need >= TMPFS_RESERVE:
+                    root = tmpfs
+        if root.free:
+            wd = root.free.pop()
+        else:
+            wd = get_unique_path(root.path)
+            os.mkdir(wd)
+        root.reserved += need
+        _owner[wd] = (root, need)
+    return wd
+def release_workdir(wd: str):
+    """
+    归还工作目录，由后台线程清空后回收。调试模式下保留工作目录。
+    """
+    global _reaper
+    if DEBUG:
+        with _lock:
+            root, need = _owner.pop(wd)
+            root.reserved -= need
+        return
+    with _lock:
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reap, name="selfeval-reaper", daemon=True)
+            _reaper.start()
+    _trash.put(wd)
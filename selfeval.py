@@ -9,14 +9,19 @@ import tempfile
 # import rich.traceback
 # rich.traceback.install(show_locals=True)
 
+from lib import userconf
 from lib.collect import process_file, collect_tests, collect_problem, collected_problem
 from lib.color import *
 from lib.core import VERSION, DEBUG, startup_recall, error, fatal, _remind, tick, tock
-from lib.ds import TestConf, JudgeConf, read_judge_conf, Verdict, Test
+from lib.datafile import isdir, isfile
+from lib.ds import Program, TestConf, JudgeConf, read_judge_conf, Verdict, Test
 from lib.fmt import LiveStream
-from lib.jury import compile_program, jury_test
+from lib.jury import compile_programs, jury_test, jury_tests
+from lib.schedule import schedule
+from lib.verdicts import VerdictStore
+from lib.watch import Watcher
 from lib.sandbox import SandboxFatalError
-from lib.utils import fmemory, path_cmp, cache_clear
+from lib.utils import fmemory, path_key, cache_clear
 
 print(BOLD("selfeval").toansi(), VERSION)
 
@@ -26,13 +31,19 @@ cache_path = tempfile.mkdtemp(prefix="selfeval-main-cache-")
 testlib_path = "/home/noilinux/selfeval/testlib.h"
 
 cmd_testconf = TestConf()
+# 重新评测的范围，见 VerdictStore
+rejudge = ""
+watching = False
 
-def main(source: str, data: list[str]):
+def collect(data: list[tuple[str, bool]]):
+    """
+    收集测试点和题目配置，返回 (测试点, 测试点配置, 评测配置)，失败时返回 None。
+    """
     tests: list[Test] = []
     testconf = TestConf()
     with collect_problem(): # 一般题目只有一个数据文件夹，但是为了实现当前目录下不递归地收集数据，实现成允许收集多个文件夹的方式
         for d, flag in data:
-            if not os.path.isdir(d):
+            if not isdir(d):
                 continue
             if flag:
                 ts, cnf = collect_tests(d)
@@ -41,9 +52,9 @@ def main(source: str, data: list[str]):
                     testconf.update(cnf)
             else:
                 for file in os.listdir(d):
-                    process_file(os.path.join(d, file), testcase=False)
+                    process_file(os.path.join(d, file))
     testconf.update(cmd_testconf)
-    tests.sort(key=lambda x: path_cmp(x.tests[0][0]))
+    tests.sort(key=lambda x: path_key(x.tests[0][0]))
     if not tests:
         print("无数据。")
         return
@@ -51,47 +62,119 @@ def main(source: str, data: list[str]):
     # TODO 如果 manifest.json 在校验器/交互库之后被修改，需要重新编译（见 ds 模块的 ResourceDependency）
     # TODO 当获取到的配置不合常理（例如时间限制 1ms）时，需要弹出提示
     for d, flag in data:
-        if os.path.isfile(p := os.path.join(d, "manifest.json")):
+        if isfile(p := os.path.join(d, "manifest.json")):
             if (cnf := read_judge_conf(p)) is not None:
                 problem.update(cnf)
     if problem.name is not None and problem.interactor is not None:
         error("使用文件读写时不能使用交互库。")
         return
-    prog = compile_program(cache_path, source, None, "c++14:O2", problem.headers, problem.graders, "program")
-    if prog is None:
-        error("编译失败。")
-        return
-    if isinstance(prog, Verdict):
-        error(f"编译失败，编译器退出状态为 {repr(prog)}")
-        return
+    return tests, testconf, problem
+def compile_tasks(source: str, problem: JudgeConf):
     # TODO 支持自定义编译选项
-    # TODO 缓存编译结果
     # TODO 收集数据文件夹中的 testlib
-    checker = problem.checker
-    if checker is not None:
-        problem.checker = compile_program(cache_path, checker, problem.checker_backup, problem.checker_conf.lang, [testlib_path], [], "checker")
-        if problem.get_real("checker") is None:
-            error(f"校验器 {checker} 编译失败。")
-            return
-        if isinstance(problem.get_real("checker"), Verdict):
-            error(f"校验器 {checker} 编译失败，编译器退出状态为 {repr(problem.get_real("checker"))}")
-            return
+    # 校验器和交互库使用 testlib.h 的预编译头
+    tasks = {"program": (source, None, "c++14:O2", problem.headers, problem.graders)}
+    if (checker := problem.checker) is not None:
+        tasks["checker"] = (checker, problem.checker_backup, problem.checker_conf.lang, [testlib_path], [], True)
     if (interactor := problem.interactor) is not None:
-        problem.interactor = compile_program(cache_path, interactor, problem.interactor_backup, problem.interactor_conf.lang, [testlib_path], [], "interactor")
-        if problem.get_real("interactor") is None:
-            error(f"交互库 {interactor} 编译失败。")
+        tasks["interactor"] = (interactor, problem.interactor_backup, problem.interactor_conf.lang, [testlib_path], [], True)
+    return tasks
+def _stat(path: str | None):
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return path, st.st_size, st.st_mtime_ns, st.st_ino
+def _signature(task: tuple):
+    source, backup, lang, headers, graders, *pch = task
+    return lang, tuple(pch), tuple(_stat(x) for x in (source, backup, *headers, *graders))
+def compile_all(tasks: dict[str, tuple], compiled: dict[str, tuple[tuple, Program]]):
+    """
+    编译 tasks 中的程序，返回 usage 到编译结果的映射，失败时返回 None。
+    compiled 记录上次编译的 (签名, 编译结果)，源文件和编译参数都没有变化的程序不再编译。
+    """
+    todo = {usage: task for usage, task in tasks.items() if usage not in compiled or compiled[usage][0] != _signature(task)}
+    names = {usage: "" if usage == "program" else f"{'校验器' if usage == 'checker' else '交互库'} {task[0]} " for usage, task in tasks.items()}
+    # 选手程序、校验器、交互库同时编译，任一失败时立即报告并终止其余编译
+    for usage, ret in compile_programs(cache_path, todo) if todo else ():
+        if ret is None:
+            error(f"{names[usage]}编译失败。")
             return
-        if isinstance(problem.get_real("interactor"), Verdict):
-            error(f"交互库 {interactor} 编译失败，编译器退出状态为 {repr(problem.get_real("interactor"))}")
+        if isinstance(ret, Verdict):
+            error(f"{names[usage]}编译失败，编译器退出状态为 {repr(ret)}")
             return
-    startup_recall()
-    live = LiveStream(tests)
+        compiled[usage] = (_signature(todo[usage]), ret)
+    return {usage: compiled[usage][1] for usage in tasks}
+def judge(progs: dict[str, Program], tests: list[Test], testconf: TestConf, problem: JudgeConf):
+    problem = copy.deepcopy(problem)
+    for usage, ret in progs.items():
+        if usage != "program":
+            setattr(problem, usage, ret)
+    prog = progs["program"]
     for test in tests:
-        jury_test(cache_path, prog, copy.deepcopy(testconf), problem, test, live)
+        test.result = []
+    if userconf.acquire_judge_verdict_cache() or userconf.acquire_judge_output_store() or userconf.acquire_judge_check_cache() or userconf.acquire_judge_schedule():
+        store = VerdictStore(prog, problem, rejudge, verdicts=userconf.acquire_judge_verdict_cache(), outputs=userconf.acquire_judge_output_store(), checks=userconf.acquire_judge_check_cache())
+    else:
+        store = None
+    if store is not None:
+        store.prefetch([p for test in tests for tc in test.tests for p in tc])
+    if userconf.acquire_judge_schedule():
+        schedule(tests, store)
+    live = LiveStream(tests)
+    try:
+        if (jobs := userconf.acquire_judge_jobs()) > 1:
+            jury_tests(cache_path, prog, testconf, problem, tests, live, jobs, store)
+        else:
+            for test in tests:
+                jury_test(cache_path, prog, copy.deepcopy(testconf), problem, test, live, store)
+    finally:
+        if store is not None:
+            store.close()
     print()
     live.print_conclusion()
+def main(source: str, data: list[tuple[str, bool]]):
+    if (collected := collect(data)) is None:
+        return
+    if (progs := compile_all(compile_tasks(source, collected[2]), {})) is None:
+        return
+    startup_recall()
+    judge(progs, *collected)
+def watch(source: str, data: list[tuple[str, bool]]):
+    """
+    常驻监视源文件、数据文件夹和当前目录，文件变化时重新评测。
+    只有源文件变化时不重新收集数据；只重新编译源文件或编译参数变化的程序；未受影响的测试点直接使用存储的评测结果（见 VerdictStore）。
+    """
+    compiled: dict[str, tuple[tuple, Program]] = {}
+    collected = None
+    changed: set[str] = set()
+    startup_recall()
+    cwd = os.getcwd()
+    with Watcher() as watcher:
+        while True:
+            if collected is None or any(path != source for path in changed):
+                collected = collect(data)
+            # 目录可能被删除后重新创建，每次都重新添加监视
+            for d, flag in data:
+                if os.path.isdir(d):
+                    watcher.add(d, flag)
+            if os.path.isdir(os.path.dirname(source)):
+                watcher.add(os.path.dirname(source))
+            if collected is not None and (progs := compile_all(compile_tasks(source, collected[2]), compiled)) is not None:
+                judge(progs, *collected)
+            print()
+            print("正在监视文件变化，按 Ctrl+C 退出。")
+            changed = watcher.wait()
+            print()
+            print("文件发生变化：", ", ".join(sorted(repr(os.path.relpath(path, cwd)) for path in changed)))
 
+def set_jobs(val: str):
+    if not val.isdigit() or int(val) < 1:
+        error(f"选项 --jobs={val} 无效，并行评测数必须是正整数。", True)
+        return
+    userconf.UserJudge.jobs = int(val)
 def parse_argv(argv: list[str]):
+    global rejudge, watching
     i = -1
     raw = False
     lst = []
@@ -115,6 +198,20 @@ def parse_argv(argv: list[str]):
             pass
         elif arg == "--clean":
             cache_clear()
+        elif arg == "--rejudge":
+            rejudge = "all"
+        elif arg == "--rejudge-failed":
+            rejudge = "failed"
+        elif arg == "--watch":
+            watching = True
+        elif arg in ("-j", "--jobs"):
+            if i + 1 == len(argv):
+                error(f"选项 {arg} 缺少参数。", True)
+            else:
+                i += 1
+                set_jobs(argv[i])
+        elif arg.startswith("--jobs="):
+            set_jobs(arg[7:])
         elif arg == "--ignore-recall":
             atexit.unregister(_remind)
         elif arg.startswith("--") and arg.find("=") != -1:
@@ -146,15 +243,19 @@ def starter():
         atexit.register(lambda: shutil.rmtree(cache_path))
     prog = os.path.abspath("1.cpp" if len(lst) < 1 else lst[0])
     # data = [os.path.join(os.path.dirname(prog), path) for path in (["data"] if len(lst) < 2 else lst[1:])]
+    # 没有数据文件夹时直接读取同名的 zip 文件（例如备份得到的 data.bak.zip），不需要解压
     data = [
-        (os.path.abspath("data"), True),
+        (next((path for x in ("data", "data.zip", "data.bak.zip") if os.path.exists(path := os.path.abspath(x))), os.path.abspath("data")), True),
         (os.getcwd(), False),
     ]
     if len(lst) > 2:
         for x in range(2, len(lst)):
             error(f"冗余参数 {repr(lst[x])}")
     try:
-        main(prog, data)
+        if watching:
+            watch(prog, data)
+        else:
+            main(prog, data)
     except KeyboardInterrupt:
         print()
         print("评测被打断。")